@@ -0,0 +1,142 @@
+import argparse
+import json
+import chess
+import chess.pgn
+import numpy as np
+from train import ChessAI
+
+
+def as_game(game, board=None):
+    # Accept a chess.pgn.Game or a list of moves (like ChessGame.notation) played from `board`
+    if isinstance(game, chess.pgn.Game):
+        return game
+    board = board.copy() if board is not None else chess.Board()
+    for move in game:
+        board.push(move)
+    return chess.pgn.Game.from_board(board)
+
+
+def replay(game):
+    # The position before every mainline move, paired with the move played in it
+    board = game.board()
+    positions = []
+    for move in game.mainline_moves():
+        positions.append((board.copy(stack=False), move))
+        board.push(move)
+    return positions
+
+
+def tablebase_blunder(tables, board, move):
+    # True when the endgame tables show the move throws away a win or a draw
+    before = tables.wdl(board)
+    if before is None:
+        return False
+    board.push(move)
+    after = tables.wdl(board)
+    board.pop()
+    return after is not None and -after < before
+
+
+def analyse_games(chess_ai, games, blunder_ratio=0.1):
+    # Score every position of every game in one batched forward pass. Each move gets its rank
+    # among the legal moves (1 is the model's favourite) and its probability, renormalised over
+    # the legal moves. A move is a suspected blunder when the model likes it less than
+    # `blunder_ratio` times its best move, or when the endgame tables say it loses value.
+    games = [as_game(game) for game in games]
+    positions = [replay(game) for game in games]
+    boards = [board for game_positions in positions for board, _ in game_positions]
+    predictions = chess_ai.predict_policies(boards) if boards else []
+
+    analyses = []
+    start = 0
+    for game, game_positions in zip(games, positions):
+        moves = []
+        for (board, move), prediction in zip(game_positions, predictions[start:start + len(game_positions)]):
+            legal_moves = list(board.legal_moves)
+            scores = np.maximum(chess_ai.move_scores(prediction, legal_moves), 0)
+            total = scores.sum()
+            probabilities = scores / total if total > 0 else np.full(len(scores), 1 / len(scores))
+            played = legal_moves.index(move)
+            best = int(np.argmax(probabilities))
+            blunder = bool(played != best and probabilities[played] < blunder_ratio * probabilities[best])
+            if chess_ai.tablebases is not None and tablebase_blunder(chess_ai.tablebases, board, move):
+                blunder = True
+
+            moves.append({"ply": board.ply() + 1, "san": board.san(move), "uci": move.uci(),
+                          "rank": int((probabilities > probabilities[played]).sum()) + 1,
+                          "legal_moves": len(legal_moves), "probability": float(probabilities[played]),
+                          "best": board.san(legal_moves[best]), "best_probability": float(probabilities[best]),
+                          "blunder": blunder})
+        start += len(game_positions)
+        analyses.append({"headers": dict(game.headers), "moves": moves,
+                         "blunders": sum(move["blunder"] for move in moves)})
+
+    return analyses
+
+
+def analyse_game(chess_ai, game, blunder_ratio=0.1):
+    return analyse_games(chess_ai, [game], blunder_ratio)[0]
+
+
+def annotate(game, analysis, annotator="ChessAI"):
+    # A copy of the game with the analysis as move comments and ?? on suspected blunders
+    game = as_game(game)
+    annotated = chess.pgn.Game.from_board(game.end().board())
+    annotated.headers.update(game.headers)
+    annotated.headers["Annotator"] = annotator
+
+    for node, move in zip(annotated.mainline(), analysis["moves"]):
+        node.comment = f"rank {move['rank']}/{move['legal_moves']} p={move['probability']:.3f}"
+        if move["rank"] > 1:
+            node.comment += f", model prefers {move['best']} p={move['best_probability']:.3f}"
+        if move["blunder"]:
+            node.nags.add(chess.pgn.NAG_BLUNDER)
+
+    return annotated
+
+
+def read_games(pgn_path):
+    with open(pgn_path, encoding="utf-8", errors="replace") as f:
+        while True:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                return
+            yield game
+
+
+def game_batches(games, batch_size):
+    batch = []
+    for game in games:
+        batch.append(game)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Annotate games with the model's view of every move")
+    parser.add_argument("pgn")
+    parser.add_argument("--model", default="chess_model.h5")
+    parser.add_argument("--backend", default="numpy", choices=["numpy", "keras", "remote"])
+    parser.add_argument("--tablebases", default=None, help="endgame table directory for exact blunder checks")
+    parser.add_argument("--blunder-ratio", type=float, default=0.1)
+    parser.add_argument("--games-per-batch", type=int, default=64, help="games scored in one forward pass")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per game instead of PGN")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    chess_ai = ChessAI()
+    chess_ai.load_model(args.model, backend=args.backend)
+    if args.tablebases:
+        chess_ai.load_tablebases(args.tablebases)
+
+    for games in game_batches(read_games(args.pgn), args.games_per_batch):
+        for game, analysis in zip(games, analyse_games(chess_ai, games, args.blunder_ratio)):
+            if args.json:
+                print(json.dumps(analysis))
+            else:
+                print(annotate(game, analysis), end="\n\n")
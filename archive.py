@@ -0,0 +1,131 @@
+import io
+import os
+import chess
+import chess.pgn
+import chess.polyglot
+import numpy as np
+
+# One index record per distinct position of a game: Zobrist key and byte offset of the game
+INDEX_DTYPE = np.dtype([("key", "<u8"), ("offset", "<u8")])
+
+
+def position_keys(game):
+    # Zobrist keys of every position reached in the game's mainline, start position included
+    board = game.board()
+    keys = [chess.polyglot.zobrist_hash(board)]
+    for move in game.mainline_moves():
+        board.push(move)
+        keys.append(chess.polyglot.zobrist_hash(board))
+    return sorted(set(keys))
+
+
+def read_run(path):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.memmap(path, dtype=INDEX_DTYPE, mode="r")
+
+
+def sort_by_key(records):
+    # Stable, so records of the same position stay in archive order
+    return records[np.argsort(records["key"], kind="stable")]
+
+
+class GameArchive:
+    # Append-only PGN file plus an index of (position key, game offset) records sorted by key.
+    # Games are buffered in memory and written in one go by flush(), which also runs once more
+    # than `buffer_size` bytes are pending and on close(). Each flush writes its records as a
+    # sorted run in the index directory, and a run is merged into the one before it once that
+    # one is no bigger, so there are O(log n) runs and find() binary-searches each of them.
+    def __init__(self, directory="game_history", name="games", buffer_size=64 * 1024):
+        self.pgn_path = os.path.join(directory, name + ".pgn")
+        self.index_path = os.path.join(directory, name + ".idx")
+        os.makedirs(self.index_path, exist_ok=True)
+        self.buffer_size = buffer_size
+        self.size = os.path.getsize(self.pgn_path) if os.path.exists(self.pgn_path) else 0
+        self.runs = sorted(os.path.join(self.index_path, f) for f in os.listdir(self.index_path)
+                           if f.endswith(".run"))
+        self.pending = []
+        self.pending_index = []
+        self.pending_size = 0
+
+    def __len__(self):
+        # Number of flushed games: every game indexes at least its start position once
+        return len(np.unique(self.index()["offset"]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, pgn, keys):
+        # Append a game given as PGN text and its position keys; returns the game's offset
+        data = (pgn.strip() + "\n\n").encode()
+        offset = self.size + self.pending_size
+        self.pending.append(data)
+        self.pending_index.append(np.array([(key, offset) for key in keys], dtype=INDEX_DTYPE))
+        self.pending_size += len(data)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+        return offset
+
+    def add_game(self, game):
+        return self.add(str(game), position_keys(game))
+
+    def flush(self):
+        if not self.pending:
+            return
+        with open(self.pgn_path, "ab") as f:
+            f.write(b"".join(self.pending))
+        # The index only ever points at games that are already on disk
+        sequence = int(os.path.basename(self.runs[-1])[:-4]) + 1 if self.runs else 0
+        self.write_run(os.path.join(self.index_path, f"{sequence:010d}.run"),
+                       sort_by_key(np.concatenate(self.pending_index)))
+        self.size += self.pending_size
+        self.pending, self.pending_index, self.pending_size = [], [], 0
+        self.merge_runs()
+
+    def write_run(self, path, records):
+        with open(path + ".tmp", "wb") as f:
+            records.tofile(f)
+        os.replace(path + ".tmp", path)
+        if path not in self.runs:
+            self.runs.append(path)
+
+    def merge_runs(self):
+        # The merged run replaces the newer file before the older one is removed; if that is
+        # interrupted, records are only duplicated, and find() returns each game once anyway
+        while len(self.runs) > 1 and os.path.getsize(self.runs[-2]) <= os.path.getsize(self.runs[-1]):
+            older, newer = self.runs[-2], self.runs[-1]
+            self.write_run(newer, sort_by_key(np.concatenate([read_run(older), read_run(newer)])))
+            os.remove(older)
+            self.runs.remove(older)
+
+    def close(self):
+        self.flush()
+
+    def index(self):
+        # Every flushed record, sorted within each run
+        if not self.runs:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.concatenate([read_run(path) for path in self.runs])
+
+    def find(self, position):
+        # Offsets of all flushed games that reach `position` (a board or a FEN), in archive order.
+        # Only O(log n) records of each run are touched.
+        board = chess.Board(position) if isinstance(position, str) else position
+        key = np.uint64(chess.polyglot.zobrist_hash(board))
+        offsets = set()
+        for path in self.runs:
+            run = read_run(path)
+            start, end = np.searchsorted(run["key"], key, "left"), np.searchsorted(run["key"], key, "right")
+            offsets.update(int(offset) for offset in run["offset"][start:end])
+        return sorted(offsets)
+
+    def read_game(self, offset):
+        with open(self.pgn_path, "rb") as f:
+            f.seek(offset)
+            return chess.pgn.read_game(io.TextIOWrapper(f, encoding="utf-8"))
+
+    def games_with_position(self, position):
+        return [self.read_game(offset) for offset in self.find(position)]
@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import numpy as np
+from moves import select_moves
+from sampler import PositionSampler
+from train import ChessAI, generate_batch
+
+BATCH_SIZES = (1, 4, 16, 64, 256, 1024)
+
+
+def timed(function, repeat=5, number=1):
+    # Median seconds per call over `repeat` runs of `number` calls each
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        runs.append((time.perf_counter() - start) / number)
+    return statistics.median(runs)
+
+
+def rate(value):
+    return {"value": value, "unit": "per_sec", "higher_is_better": True}
+
+
+def latency(seconds):
+    return {"value": seconds * 1000, "unit": "ms", "higher_is_better": False}
+
+
+def seeded_boards(count, max_depth=60, seed=0):
+    rng = random.Random(seed)
+    return [ChessAI.random_board(max_depth, rng) for _ in range(count)]
+
+
+def bench_encoding(boards):
+    results = {}
+    legacy, planes = ChessAI("legacy"), ChessAI("planes")
+    results["encode_position_legacy"] = rate(len(boards) / timed(lambda: [legacy.encode_position(b) for b in boards]))
+    out = np.zeros((len(boards), 64 * 18), dtype=np.int8)
+    results["encode_positions_planes"] = rate(len(boards) / timed(lambda: planes.encode_positions(boards, out)))
+    return results
+
+
+def bench_prediction(ai, boards):
+    # Forward pass only, on batches encoded up front; predict_move is the whole single-move path
+    results = {}
+    encoded = ai.encode_positions(boards)
+    for batch_size in BATCH_SIZES:
+        batch = encoded[:batch_size]
+        results[f"predict_batch_{batch_size}"] = latency(timed(lambda: ai.predict_encoded(batch)))
+    results["predict_move"] = latency(timed(lambda: ai.predict_move(boards[0]), number=20))
+    return results
+
+
+def bench_decoding(ai, boards):
+    # Picking the best legal move from predictions, legal moves generated up front
+    predictions = ai.predict_policies(boards)
+    legal_moves = [list(board.legal_moves) for board in boards]
+
+    def decode_all():
+        for prediction, moves in zip(predictions, legal_moves):
+            ai.decode_move(prediction, moves)
+
+    return {"decode_move": latency(timed(decode_all) / len(boards)),
+            f"decode_batch_{len(boards)}": latency(timed(lambda: select_moves(predictions, legal_moves)))}
+
+
+def bench_generation(count, max_depth):
+    rng = random.Random(0)
+    results = {"random_board": rate(count / timed(lambda: [ChessAI.random_board(max_depth, rng) for _ in range(count)],
+                                                  repeat=3))}
+    results["training_samples"] = rate(count / timed(lambda: generate_batch(count, max_depth, "planes", 0), repeat=3))
+    results["unique_positions"] = rate(count / timed(lambda: PositionSampler(100, seed=0).sample(count), repeat=3))
+    return results
+
+
+def bench_training_step(count, max_depth):
+    # model.fit throughput on pre-generated samples; skipped when TensorFlow isn't installed
+    try:
+        import tensorflow  # noqa: F401
+    except ImportError:
+        return {}
+    ai = ChessAI()
+    model = ai.build_model()
+    X, y = generate_batch(count, max_depth, "planes", 0)
+    model.fit(X, y, epochs=1, verbose=0)  # Build and warm up
+    return {"training_fit": rate(count / timed(lambda: model.fit(X, y, epochs=1, verbose=0), repeat=3))}
+
+
+def bench_rendering(frames=200):
+    # Frame time of draw_chessboard on an off-screen display, idle and with a full repaint
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    from board import ChessGame
+
+    # Nothing is saved and the engine is never asked for a move, so its model isn't loaded
+    game = ChessGame(warm_up=False)
+    game.game_state = "Chessboard"
+    game.board = seeded_boards(1, seed=1)[0]
+
+    def full_frame():
+        game.draw_background()
+        game.draw_chessboard()
+
+    results = {"draw_chessboard_full": latency(timed(full_frame, number=frames)),
+               "draw_chessboard_idle": latency(timed(game.draw_chessboard, number=frames))}
+    game.engine_worker.stop()
+    return results
+
+
+def bench_serving(ai, clients=16, requests_per_client=100):
+    # Overhead of sharing one model: one position per request from concurrent threads, separate
+    # calls vs a shared BatchingModel. For the small NumPy model the shared one is expected to be slower.
+    from serving import BatchingModel, measure_throughput
+    batching = BatchingModel(ai.model)
+    results = {f"serving_direct_{clients}": rate(measure_throughput(ai.model, clients, requests_per_client)),
+               f"serving_batched_{clients}": rate(measure_throughput(batching, clients, requests_per_client))}
+    batching.close()
+    return results
+
+
+def run_benchmarks(model_path, backend="numpy", quick=False):
+    boards = seeded_boards(max(BATCH_SIZES))
+    ai = ChessAI()
+    ai.load_model(model_path, backend=backend)
+    count = 200 if quick else 2000
+
+    results = {}
+    results.update(bench_encoding(boards))
+    results.update(bench_prediction(ai, boards))
+    results.update(bench_decoding(ai, boards[:256]))
+    results.update(bench_serving(ai))
+    results.update(bench_generation(count, 3))
+    results.update(bench_training_step(count, 3))
+    results.update(bench_rendering(50 if quick else 200))
+
+    return {"python": sys.version.split()[0], "platform": platform.platform(), "backend": backend,
+            "results": results}
+
+
+def compare(current, baseline, tolerance=0.2):
+    # Metrics that got worse than the baseline by more than `tolerance` (a fraction)
+    regressions = []
+    for name, metric in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        if metric["higher_is_better"]:
+            change = base["value"] / metric["value"] - 1
+        else:
+            change = metric["value"] / base["value"] - 1
+        if change > tolerance:
+            regressions.append((name, base["value"], metric["value"], metric["unit"]))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the engine and GUI hot paths")
+    parser.add_argument("--model", default="chess_model.h5")
+    parser.add_argument("--backend", default="numpy", choices=["numpy", "keras"])
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="fail if results regress against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--quick", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmarks(args.model, args.backend, args.quick)
+
+    for name, metric in report["results"].items():
+        print(f"{name:32} {metric['value']:14.3f} {metric['unit']}")
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for name, before, after, unit in regressions:
+            print(f"REGRESSION {name}: {before:.3f} -> {after:.3f} {unit}")
+        sys.exit(1 if regressions else 0)
@@ -1,15 +1,93 @@
+import os
 import sys
 from datetime import datetime
 import pygame
 import chess
 import chess.engine
+import chess.pgn
 import time
-from train import ChessAI
-import threading
+from concurrent.futures import Future
+from archive import GameArchive
+from engine_worker import EngineWorker
+from profiling import PROFILER
+
+# Text shown on the game over screen for each way a game can end
+OUTCOME_TEXT = {
+    chess.Termination.CHECKMATE: "Checkmate",
+    chess.Termination.STALEMATE: "Stalemate",
+    chess.Termination.INSUFFICIENT_MATERIAL: "Insufficient Material",
+    chess.Termination.SEVENTYFIVE_MOVES: "75 Moves",
+    chess.Termination.FIVEFOLD_REPETITION: "5 Fold Repetition",
+}
+
+# Engine of the engine worker process, built by load_engine
+ENGINE = {}
+
+
+def load_engine(depth=0):
+    # Runs in the engine worker process, so the window comes up before any of the ML code is imported
+    from train import ChessAI
+    from search import SearchEngine
+
+    engine = ChessAI()
+    engine.load_model("chess_model.h5", backend="numpy")
+    if os.path.exists("book.bin"):
+        engine.load_book("book.bin")
+    if os.path.isdir("tablebases"):
+        engine.load_tablebases("tablebases")
+    engine.predict_move(chess.Board())  # Warm-up prediction
+    ENGINE["search"] = SearchEngine(engine, depth or 3)
+    ENGINE["ai"] = engine
+
+
+def choose_engine_move(board, depth=0, remaining=None, increment=0):
+    # Runs in the engine worker process and only ever sees a copy of the board
+    if "ai" not in ENGINE:
+        load_engine(depth)
+    search = ENGINE["search"]
+    # think() answers a forced move without searching, so don't report the last search's counts again
+    search.reset_stats()
+    if depth:
+        move = search.search(board, depth)
+    elif remaining is not None:
+        # Anytime search: as deep as the move's share of the clock allows
+        move = search.think(board, remaining, increment)
+    else:
+        return ENGINE["ai"].predict_move(board)
+    # Sent back to the GUI's profiler with the move, for the overlay's hit rate
+    PROFILER.count("tt_probes", search.tt.probes)
+    PROFILER.count("tt_hits", search.tt.hits)
+    return move
+
+
+def analyse_game(game):
+    # Runs in the engine worker process: every position of the game is scored in one forward pass
+    from analysis import analyse_game, annotate
+
+    if "ai" not in ENGINE:
+        load_engine()
+    analysis = analyse_game(ENGINE["ai"], game)
+    print(annotate(game, analysis))
+    print(f"{analysis['blunders']} suspected blunders")
+
+
+class PositionState:
+    # What the GUI needs to know about one position, computed once when the position is reached
+    def __init__(self, board):
+        self.moves_from = {}
+        for move in board.legal_moves:
+            self.moves_from.setdefault(move.from_square, []).append(move)
+        self.is_check = board.is_check()
+        self.outcome = board.outcome()
+        self.is_game_over = self.outcome is not None
+        if self.is_game_over:
+            self.outcome_text = OUTCOME_TEXT.get(self.outcome.termination, "Game Over")
+        else:
+            self.outcome_text = "Check" if self.is_check else "Game Over"
 
 
 class ChessGame:
-    def __init__(self):
+    def __init__(self, stats_path=None, warm_up=True, profile_path=None):
         # Define some colors
         self.LIGHT_BROWN = (232, 204, 168)
         self.DARK_BROWN = (176, 142, 112)
@@ -22,6 +100,7 @@ class ChessGame:
         self.time = 60 * 5
         self.black_time = self.time
         self.white_time = self.time
+        self.increment = 0  # Seconds added to a player's clock after each of their moves
 
         # Initialize Pygame
         pygame.init()
@@ -50,9 +129,18 @@ class ChessGame:
         # Create stuff for engine
         self.if_engine = False
         self.if_engine_vs_engine = False
-        self.engine = None
-        self.engine_thread_black = None
-        self.engine_thread_white = None
+        self.engine_depth = 0  # 0 searches as deep as the engine's clock allows, otherwise to this fixed depth
+        # Under --profile the engine process writes its own stats next to the GUI's
+        self.engine_worker = EngineWorker(choose_engine_move, profile_path + ".engine" if profile_path else None)
+        self.engine_future = None
+        self.engine_request_fen = None
+        # Load and warm up the model in the background while the main menu is up. Without warm_up
+        # the model is only loaded by the first engine move.
+        if warm_up:
+            self.engine_loading = self.engine_worker.call(load_engine, self.engine_depth)
+        else:
+            self.engine_loading = Future()
+            self.engine_loading.set_result(None)
 
         # Load piece images
         self.piece_images = {}
@@ -70,9 +158,17 @@ class ChessGame:
         self.selected_piece_pos = None
         self.valid_moves = []
 
+        # Legal moves and game over status of the current position, see position_state()
+        self.state = None
+        self.state_key = None
+
         # Store the notation of played moves
         self.notation = []
 
+        # Finished games are appended to one indexed archive in game_history/, opened on the first save
+        self.archive = None
+        self.game_saved = False
+
         # Start the clock
         self.start_time = time.time()
 
@@ -88,6 +184,17 @@ class ChessGame:
         # Store the game state
         self.game_state = "MainMenu"
 
+        # Rendering caches: rendered text, static backgrounds and what is currently on screen
+        self.text_cache = {}
+        self.build_static_surfaces()
+        self.drawn_state = None
+
+        # Profiling overlay (toggled with F3) and where to export the collected timings on quit
+        self.show_overlay = False
+        self.stats_path = stats_path
+        if stats_path is not None:
+            PROFILER.enabled = True
+
     def run(self):
         # Main game loop
         running = True
@@ -96,6 +203,16 @@ class ChessGame:
                 if event.type == pygame.QUIT:
                     running = False
 
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    # Toggle the profiling overlay; timings are only collected while it's on or exported
+                    self.show_overlay = not self.show_overlay
+                    PROFILER.enabled = self.show_overlay or self.stats_path is not None
+                    self.drawn_state = None
+
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_a and self.game_state == "GameOver":
+                    # Analyse the finished game in the engine process, the annotated PGN is printed when ready
+                    self.engine_worker.call(analyse_game, self.build_game())
+
                 elif event.type == pygame.MOUSEBUTTONDOWN:
                     if self.game_state == "MainMenu":
                         # Check if the "Player vs Player" button was clicked
@@ -108,7 +225,7 @@ class ChessGame:
 
                         # Check if the "Player vs Computer" button was clicked
                         player_vs_computer_button_rect = pygame.Rect(50, 350, 230, 50)
-                        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and not self.engine_failed():
                             if player_vs_computer_button_rect.collidepoint(event.pos):
                                 self.game_state = "Chessboard"
                                 self.if_engine = True
@@ -116,7 +233,7 @@ class ChessGame:
 
                         # Check if the "Computer vs Computer" button was clicked
                         computer_vs_computer_button_rect = pygame.Rect(50, 450, 230, 50)
-                        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and not self.engine_failed():
                             if computer_vs_computer_button_rect.collidepoint(event.pos):
                                 self.game_state = "Chessboard"
                                 self.if_engine_vs_engine = True
@@ -129,14 +246,7 @@ class ChessGame:
                                 running = False
 
                     elif self.game_state == "GameOver":
-                        if self.engine_thread_white is not None:
-                            self.engine_thread_white.join()
-                            self.engine_thread_white = None
-                        if self.engine_thread_black is not None:
-                            self.engine_thread_black.join()
-                            self.engine_thread_black = None
-                        self.engine_thread_white = None
-                        self.engine_thread_black = None
+                        self.cancel_engine_move()
                         self.if_engine = False
                         self.if_engine_vs_engine = False
                         # Check if the "Main Menu" button was clicked
@@ -144,7 +254,11 @@ class ChessGame:
                         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
                             if main_menu_button_rect.collidepoint(event.pos):
                                 self.board.reset()
+                                self.white_time = self.time
+                                self.black_time = self.time
                                 self.notation = []
+                                self.state_key = None
+                                self.game_saved = False
                                 self.game_state = "MainMenu"
                                 continue
 
@@ -159,11 +273,14 @@ class ChessGame:
                         export_pgn_button_rect = pygame.Rect(50, 550, 230, 50)
                         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
                             if export_pgn_button_rect.collidepoint(event.pos):
-                                print(self.notation)
                                 self.export_pgn()
                                 continue
 
                     elif self.game_state == "Chessboard":
+                        # Ignore clicks while the engine is on the move
+                        if self.is_engine_turn():
+                            continue
+
                         # Handle chessboard events
                         x, y = pygame.mouse.get_pos()
                         if x > self.board_size:
@@ -207,236 +324,338 @@ class ChessGame:
 
                             if move in self.valid_moves:
                                 # If the move is valid, update the board
-                                self.board.push(move)
-                                self.notation.append(move)
+                                self.push_move(move)
                                 print(self.notation)
                                 self.valid_moves = []
                             # Reset the selected piece and its position
                             self.selected_piece = None
                             self.selected_piece_pos = None
 
-            # Clear the screen
-            self.screen.fill(self.GRAY)
-
-            if self.game_state == "MainMenu":
-                self.draw_main_menu()
-            elif self.game_state == "Chessboard":
-                self.draw_chessboard()
-            elif self.game_state == "GameOver":
-                self.draw_game_over()
-
-            # Update the display
-            pygame.display.flip()
+            # Ask the engine for a move or play the one it found
+            if self.game_state == "Chessboard":
+                self.update_engine()
+
+            # Repaint the whole window only when switching screens, otherwise just what changed
+            with PROFILER.timer("render"):
+                dirty_rects = []
+                if self.game_state != self.drawn_state:
+                    self.draw_background()
+                    dirty_rects.append(self.screen.get_rect())
+
+                if self.game_state == "MainMenu":
+                    dirty_rects += self.draw_main_menu()
+                elif self.game_state == "Chessboard":
+                    dirty_rects += self.draw_chessboard()
+                    if self.show_overlay:
+                        dirty_rects += self.draw_overlay()
+                elif self.game_state == "GameOver":
+                    dirty_rects += self.draw_game_over()
+
+                # Update the display
+                pygame.display.update(dirty_rects)
 
             # Control the frame rate
-            self.clock.tick(60)
+            PROFILER.record("frame", self.clock.tick(60) / 1000)
 
-            # decrement the correct players clock
-            if self.board.turn == chess.BLACK:
-                self.black_time -= (time.time() - self.start_time)
-            else:
-                self.white_time -= (time.time() - self.start_time)
-            self.start_time = time.time()
+            # decrement the correct players clock, the clocks only run during a game
+            now = time.time()
+            if self.game_state == "Chessboard":
+                if self.board.turn == chess.BLACK:
+                    self.black_time -= (now - self.start_time)
+                else:
+                    self.white_time -= (now - self.start_time)
+            self.start_time = now
 
             # Check if the game is over
-            if self.board.is_game_over():
+            if self.position_state().is_game_over and self.game_state != "GameOver":
                 self.game_state = "GameOver"
+                self.save_game()
 
         # Quit the game
+        if self.stats_path is not None:
+            PROFILER.export(self.stats_path)
+        self.cancel_engine_move()
+        self.engine_worker.stop()
+        if self.archive is not None:
+            self.archive.close()
         pygame.quit()
         sys.exit(0)
 
-    def draw_main_menu(self):
-        # Draw the title
-        title_text = self.title_font.render("Chess by Adam Pawlowski", True, self.BLACK)
-        title_text_rect = title_text.get_rect(center=(self.board_size // 2, 100))
-        self.screen.blit(title_text, title_text_rect)
-
-        # Draw the "Player vs Player" button
-        start_button_rect = pygame.Rect(50, 250, 230, 50)
-        pygame.draw.rect(self.screen, self.LIGHT_BROWN, start_button_rect)
-        pygame.draw.rect(self.screen, self.DARK_BROWN, start_button_rect, 3)
-        start_button_text = self.notation_font.render("Player vs Player", True, self.BLACK)
-        start_button_text_rect = start_button_text.get_rect(center=start_button_rect.center)
-        self.screen.blit(start_button_text, start_button_text_rect)
-
-        # Draw the "Player vs Computer" button
-        player_vs_computer_button_rect = pygame.Rect(50, 350, 230, 50)
-        pygame.draw.rect(self.screen, self.LIGHT_BROWN, player_vs_computer_button_rect)
-        pygame.draw.rect(self.screen, self.DARK_BROWN, player_vs_computer_button_rect, 3)
-        player_vs_computer_button_text = self.notation_font.render("Player vs Computer", True, self.BLACK)
-        player_vs_computer_button_text_rect = player_vs_computer_button_text.get_rect(
-            center=player_vs_computer_button_rect.center)
-        self.screen.blit(player_vs_computer_button_text, player_vs_computer_button_text_rect)
-
-        # Draw the Computer vs Computer button
-        computer_vs_computer_button_rect = pygame.Rect(50, 450, 230, 50)
-        pygame.draw.rect(self.screen, self.LIGHT_BROWN, computer_vs_computer_button_rect)
-        pygame.draw.rect(self.screen, self.DARK_BROWN, computer_vs_computer_button_rect, 3)
-        computer_vs_computer_button_text = self.notation_font.render("Computer vs Computer", True, self.BLACK)
-        computer_vs_computer_button_text_rect = computer_vs_computer_button_text.get_rect(
-            center=computer_vs_computer_button_rect.center)
-        self.screen.blit(computer_vs_computer_button_text, computer_vs_computer_button_text_rect)
-
-        # Draw the "Quit" button
-        quit_button_rect = pygame.Rect(50, 550, 230, 50)
-        pygame.draw.rect(self.screen, self.LIGHT_BROWN, quit_button_rect)
-        pygame.draw.rect(self.screen, self.DARK_BROWN, quit_button_rect, 3)
-        quit_button_text = self.notation_font.render("Quit", True, self.BLACK)
-        quit_button_text_rect = quit_button_text.get_rect(center=quit_button_rect.center)
-        self.screen.blit(quit_button_text, quit_button_text_rect)
-
-    def draw_chessboard(self):
-        # Draw the chessboard squares
+    def render_text(self, font, text):
+        # Text surfaces are cached, so each label is only rendered once
+        key = (id(font), text)
+        text_surface = self.text_cache.get(key)
+        if text_surface is None:
+            text_surface = font.render(text, True, self.BLACK)
+            self.text_cache[key] = text_surface
+        return text_surface
+
+    def draw_button(self, surface, rect, text, color=None):
+        pygame.draw.rect(surface, color or self.LIGHT_BROWN, rect)
+        pygame.draw.rect(surface, self.DARK_BROWN, rect, 3)
+        button_text = self.render_text(self.notation_font, text)
+        surface.blit(button_text, button_text.get_rect(center=rect.center))
+
+    def build_static_surfaces(self):
+        # Draw the chessboard squares once
+        self.board_surface = pygame.Surface((self.board_size, self.board_size))
         for row in range(8):
             for col in range(8):
                 square_color = self.LIGHT_BROWN if (row + col) % 2 == 0 else self.DARK_BROWN
-                pygame.draw.rect(self.screen, square_color,
+                pygame.draw.rect(self.board_surface, square_color,
                                  (col * self.tile_size, row * self.tile_size, self.tile_size, self.tile_size))
 
-        # Draw the chess pieces
-        for row in range(8):
-            for col in range(8):
-                square = chess.square(col, 7 - row)
-                piece = self.board.piece_at(square)
-                if piece is not None:
-                    piece_image = self.piece_images[(piece.piece_type, piece.color)]
-                    piece_pos = (col * self.tile_size, row * self.tile_size)
-                    if square == self.selected_piece_pos:
-                        pygame.draw.rect(self.screen, self.BLUE,
-                                         (*piece_pos, self.tile_size, self.tile_size))
-                    self.screen.blit(piece_image, piece_pos)
-
-        # Draw the promotion menu
-        menu_x = self.board_size + 10
-        menu_y = (self.board_size - (self.tile_size * len(self.promotion_menu_pieces))) // 2
-        menu_width = self.sidebar_width - 20
-        menu_height = self.tile_size * len(self.promotion_menu_pieces)
-        pygame.draw.rect(self.screen, self.LIGHT_BROWN, (menu_x, menu_y, menu_width, menu_height))
-        pygame.draw.rect(self.screen, self.DARK_BROWN, (menu_x, menu_y, menu_width, menu_height), 3)
-        for i, piece_type in enumerate(self.promotion_menu_pieces):
-            piece_image = self.piece_images[(piece_type, self.board.turn)]
-            x = menu_x + (menu_width - self.tile_size) // 2
-            y = menu_y + i * self.tile_size
-            self.screen.blit(piece_image, (x, y))
-
-        # Play the engine move as black
-        if self.if_engine:
-            self.start_engine_thread_black()
-
-        if self.if_engine_vs_engine:
-            self.start_engine_thread_black()
-            self.start_engine_thread_white()
+        # Draw the main menu title and buttons once
+        self.main_menu_surface = pygame.Surface((self.window_width, self.window_height))
+        self.main_menu_surface.fill(self.GRAY)
+        title_text = self.render_text(self.title_font, "Chess by Adam Pawlowski")
+        self.main_menu_surface.blit(title_text, title_text.get_rect(center=(self.board_size // 2, 100)))
+        self.draw_button(self.main_menu_surface, pygame.Rect(50, 250, 230, 50), "Player vs Player")
+        self.draw_button(self.main_menu_surface, pygame.Rect(50, 350, 230, 50), "Player vs Computer")
+        self.draw_button(self.main_menu_surface, pygame.Rect(50, 450, 230, 50), "Computer vs Computer")
+        self.draw_button(self.main_menu_surface, pygame.Rect(50, 550, 230, 50), "Quit")
+
+        # Draw the game over buttons once
+        self.game_over_surface = pygame.Surface((self.window_width, self.window_height))
+        self.game_over_surface.fill(self.GRAY)
+        self.draw_button(self.game_over_surface, pygame.Rect(50, 350, 230, 50), "Main Menu")
+        self.draw_button(self.game_over_surface, pygame.Rect(50, 450, 230, 50), "Export FEN")
+        self.draw_button(self.game_over_surface, pygame.Rect(50, 550, 230, 50), "Export PGN")
+
+    def draw_background(self):
+        # Paint the static layer of the current screen and forget what was drawn on top of it
+        self.screen.fill(self.GRAY)
+        if self.game_state == "MainMenu":
+            self.screen.blit(self.main_menu_surface, (0, 0))
+        elif self.game_state == "Chessboard":
+            self.screen.blit(self.board_surface, (0, 0))
+        elif self.game_state == "GameOver":
+            self.screen.blit(self.game_over_surface, (0, 0))
+
+        self.drawn_state = self.game_state
+        self.drawn_squares = {}
+        self.drawn_texts = {}
+        self.drawn_promotion_turn = None
+        self.drawn_engine_failed = False
+
+    def draw_text(self, name, font, text, center):
+        # Redraw a piece of dynamic text only when it changed; returns the dirty rects
+        text_surface = self.render_text(font, text)
+        text_rect = text_surface.get_rect(center=center)
+        previous = self.drawn_texts.get(name)
+        if previous is not None and previous[0] == text:
+            return []
+
+        dirty_rects = [text_rect]
+        if previous is not None:
+            self.screen.fill(self.GRAY, previous[1])
+            dirty_rects.append(previous[1])
+        self.screen.blit(text_surface, text_rect)
+        self.drawn_texts[name] = (text, text_rect)
+        return dirty_rects
+
+    def draw_main_menu(self):
+        # Draw the engine loading state
+        dirty_rects = self.draw_text("engine_status", self.notation_font, self.engine_status(),
+                                     (self.board_size // 2, 160))
+
+        # Grey out the engine modes once the engine failed to load
+        if self.engine_failed() and not self.drawn_engine_failed:
+            for rect, text in ((pygame.Rect(50, 350, 230, 50), "Player vs Computer"),
+                               (pygame.Rect(50, 450, 230, 50), "Computer vs Computer")):
+                self.draw_button(self.screen, rect, text, self.GRAY)
+                dirty_rects.append(rect)
+            self.drawn_engine_failed = True
+        return dirty_rects
+
+    def draw_square(self, square, state):
+        col, row = chess.square_file(square), 7 - chess.square_rank(square)
+        square_rect = pygame.Rect(col * self.tile_size, row * self.tile_size, self.tile_size, self.tile_size)
+        piece, selected, valid_move = state
+
+        self.screen.blit(self.board_surface, square_rect, square_rect)
+        if piece is not None:
+            if selected:
+                pygame.draw.rect(self.screen, self.BLUE, square_rect)
+            self.screen.blit(self.piece_images[piece], square_rect)
+        if valid_move:
+            pygame.draw.circle(self.screen, self.BLUE, square_rect.center, 8)
+
+        return square_rect
+
+    def draw_chessboard(self):
+        dirty_rects = []
+
+        # Draw the squares whose piece, selection or move marker changed since the last frame
+        piece_map = self.board.piece_map()
+        destinations = set()
+        if self.selected_piece_pos is not None:
+            destinations = {move.to_square for move in self.valid_moves
+                            if move.from_square == self.selected_piece_pos}
+        for square in chess.SQUARES:
+            piece = piece_map.get(square)
+            state = ((piece.piece_type, piece.color) if piece is not None else None,
+                     square == self.selected_piece_pos, square in destinations)
+            if self.drawn_squares.get(square) != state:
+                dirty_rects.append(self.draw_square(square, state))
+                self.drawn_squares[square] = state
+
+        # Draw the promotion menu when the side to move changes
+        if self.drawn_promotion_turn != self.board.turn:
+            menu_x = self.board_size + 10
+            menu_y = (self.board_size - (self.tile_size * len(self.promotion_menu_pieces))) // 2
+            menu_width = self.sidebar_width - 20
+            menu_height = self.tile_size * len(self.promotion_menu_pieces)
+            pygame.draw.rect(self.screen, self.LIGHT_BROWN, (menu_x, menu_y, menu_width, menu_height))
+            pygame.draw.rect(self.screen, self.DARK_BROWN, (menu_x, menu_y, menu_width, menu_height), 3)
+            for i, piece_type in enumerate(self.promotion_menu_pieces):
+                piece_image = self.piece_images[(piece_type, self.board.turn)]
+                x = menu_x + (menu_width - self.tile_size) // 2
+                y = menu_y + i * self.tile_size
+                self.screen.blit(piece_image, (x, y))
+            dirty_rects.append(pygame.Rect(menu_x, menu_y, menu_width, menu_height))
+            self.drawn_promotion_turn = self.board.turn
 
         # Draw black's clock
         minutes_b = self.black_time // 60
         seconds_b = self.black_time % 60 // 1
-        clock_text_b = self.clock_font.render(f"{minutes_b:02.0f}:{seconds_b:02.0f}", True, self.BLACK)
-        clock_text_rect_b = clock_text_b.get_rect(center=(self.window_width - self.sidebar_width // 2, 50))
-        self.screen.blit(clock_text_b, clock_text_rect_b)
+        dirty_rects += self.draw_text("black_clock", self.clock_font, f"{minutes_b:02.0f}:{seconds_b:02.0f}",
+                                      (self.window_width - self.sidebar_width // 2, 50))
 
         # Draw white's clock
         minutes_w = self.white_time // 60
         seconds_w = self.white_time % 60 // 1
-        clock_text_w = self.clock_font.render(f"{minutes_w:02.0f}:{seconds_w:02.0f}", True, self.BLACK)
-        clock_text_rect_w = clock_text_w.get_rect(center=(self.window_width - self.sidebar_width // 2, 600))
-        self.screen.blit(clock_text_w, clock_text_rect_w)
-
-        # Draw the valid moves for the selected piece
-        if self.selected_piece_pos is not None:
-            for move in self.valid_moves:
-                if move.from_square == self.selected_piece_pos:
-                    dest_col, dest_row = chess.square_file(move.to_square), 7 - chess.square_rank(move.to_square)
-                    pygame.draw.circle(self.screen, self.BLUE, (
-                        dest_col * self.tile_size + self.tile_size // 2,
-                        dest_row * self.tile_size + self.tile_size // 2),
-                                       8)
+        dirty_rects += self.draw_text("white_clock", self.clock_font, f"{minutes_w:02.0f}:{seconds_w:02.0f}",
+                                      (self.window_width - self.sidebar_width // 2, 600))
+
+        return dirty_rects
+
+    def draw_overlay(self):
+        lines = [f"FPS {self.clock.get_fps():.0f}"]
+        for name, label in (("engine_move", "engine"), ("model_predict", "predict"), ("render", "render")):
+            percentiles = PROFILER.percentiles(name)
+            if percentiles:
+                lines.append(f"{label} p50 {percentiles[50]:.1f} p90 {percentiles[90]:.1f} "
+                             f"p99 {percentiles[99]:.1f} ms")
+        probes = PROFILER.counters.get("tt_probes", 0)
+        lines.append(f"tt hit rate {PROFILER.counters.get('tt_hits', 0) / probes:.0%}" if probes else "tt hit rate -")
+
+        # The overlay changes every frame, so its text isn't cached and the squares under it are redrawn next frame
+        overlay_rect = pygame.Rect(0, 0, 300, 20 * len(lines) + 10)
+        pygame.draw.rect(self.screen, self.WHITE, overlay_rect)
+        for i, line in enumerate(lines):
+            self.screen.blit(self.notation_font.render(line, True, self.BLACK), (5, 5 + 20 * i))
+        for square in chess.SQUARES:
+            col, row = chess.square_file(square), 7 - chess.square_rank(square)
+            if overlay_rect.colliderect((col * self.tile_size, row * self.tile_size, self.tile_size, self.tile_size)):
+                self.drawn_squares.pop(square, None)
+
+        return [overlay_rect]
+
+    def position_state(self):
+        # Rebuilt only after the position changes (a push, a reset or a new board), so the
+        # per-frame game over check and piece selection don't regenerate legal moves
+        board = self.board
+        key = (id(board), len(board.move_stack), board.move_stack[-1] if board.move_stack else None)
+        if key != self.state_key:
+            self.state = PositionState(board)
+            self.state_key = key
+        return self.state
 
     def get_valid_moves(self):
-        self.valid_moves = list(
-            filter(lambda move: move.from_square == self.selected_piece_pos, self.board.legal_moves))
+        self.valid_moves = list(self.position_state().moves_from.get(self.selected_piece_pos, ()))
 
     def draw_game_over(self):
-        # Draw the "Main Menu" button
-        main_menu_button_rect = pygame.Rect(50, 350, 230, 50)
-        pygame.draw.rect(self.screen, self.LIGHT_BROWN, main_menu_button_rect)
-        pygame.draw.rect(self.screen, self.DARK_BROWN, main_menu_button_rect, 3)
-        main_menu_button_text = self.notation_font.render("Main Menu", True, self.BLACK)
-        main_menu_button_text_rect = main_menu_button_text.get_rect(center=main_menu_button_rect.center)
-        self.screen.blit(main_menu_button_text, main_menu_button_text_rect)
-
-        # Draw the "Export FEN" button
-        export_fen_button_rect = pygame.Rect(50, 450, 230, 50)
-        pygame.draw.rect(self.screen, self.LIGHT_BROWN, export_fen_button_rect)
-        pygame.draw.rect(self.screen, self.DARK_BROWN, export_fen_button_rect, 3)
-        export_fen_button_text = self.notation_font.render("Export FEN", True, self.BLACK)
-        export_fen_button_text_rect = export_fen_button_text.get_rect(center=export_fen_button_rect.center)
-        self.screen.blit(export_fen_button_text, export_fen_button_text_rect)
-
-        # Draw the "Export PGN" button
-        export_pgn_button_rect = pygame.Rect(50, 550, 230, 50)
-        pygame.draw.rect(self.screen, self.LIGHT_BROWN, export_pgn_button_rect)
-        pygame.draw.rect(self.screen, self.DARK_BROWN, export_pgn_button_rect, 3)
-        export_pgn_button_text = self.notation_font.render("Export PGN", True, self.BLACK)
-        export_pgn_button_text_rect = export_pgn_button_text.get_rect(center=export_pgn_button_rect.center)
-        self.screen.blit(export_pgn_button_text, export_pgn_button_text_rect)
+        # The buttons are part of the static background, only the result text is drawn here
+        if "game_over" in self.drawn_texts:
+            return []
 
         # Draw the game over text
-        if self.board.is_checkmate():
-            text = "Checkmate"
-        elif self.board.is_stalemate():
-            text = "Stalemate"
-        elif self.board.is_insufficient_material():
-            text = "Insufficient Material"
-        elif self.board.is_seventyfive_moves():
-            text = "75 Moves"
-        elif self.board.is_fivefold_repetition():
-            text = "5 Fold Repetition"
-        elif self.board.is_check():
-            text = "Check"
-        else:
-            text = "Game Over"
-        game_over_text = self.notation_font.render(text, True, self.BLACK)
-        game_over_text_rect = game_over_text.get_rect(center=(self.window_width // 2, 100))
-        self.screen.blit(game_over_text, game_over_text_rect)
+        text = self.position_state().outcome_text
+        return self.draw_text("game_over", self.notation_font, text, (self.window_width // 2, 100))
+
+    def build_game(self):
+        game = chess.pgn.Game.from_board(self.board)
+        game.headers["Event"] = "ChessGame"
+        game.headers["Date"] = datetime.now().strftime("%Y.%m.%d")
+        game.headers["White"] = "Engine" if self.if_engine_vs_engine else "Player"
+        game.headers["Black"] = "Engine" if self.if_engine_vs_engine or self.if_engine else "Player"
+        return game
+
+    def save_game(self):
+        # Each game goes into the archive once; the write itself is buffered
+        if not self.game_saved:
+            if self.archive is None:
+                self.archive = GameArchive("game_history")
+            self.saved_offset = self.archive.add_game(self.build_game())
+            self.game_saved = True
+        return self.saved_offset
 
     def export_fen(self):
-        with open(f"game_history/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.fen", "w") as f:
+        # The final position can also be looked up in the archive with GameArchive.find(fen)
+        self.save_game()
+        self.archive.flush()
+        path = f"game_history/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.fen"
+        with open(path, "w") as f:
             f.write(self.board.fen())
+        print(f"Final position saved to {path}")
 
     def export_pgn(self):
-        print(self.notation)
-        with open(f"game_history/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.pgn", "w") as f:
-            for move in self.notation:
-                f.write(move.__str__() + " ")
-            f.write(self.board.result())
-
-    def play_engine_move(self):
-        if self.engine is None:
-            self.engine = ChessAI()
-            self.engine.load_model("chess_model.h5")
-        move = self.engine.predict_move(self.board)
-        if move is not None:
-            self.board.push(move)
-        return
-
-    def start_engine_thread_black(self):
-        if self.engine_thread_black is not None:
-            self.engine_thread_black.join()
-        self.engine_thread_black = threading.Thread(target=self.play_engine_move_black_thread)
-        self.engine_thread_black.start()
-
-    def play_engine_move_black_thread(self):
-        while self.board.turn == chess.BLACK and not self.board.is_game_over():
-            self.play_engine_move()
-
-    def start_engine_thread_white(self):
-        if self.engine_thread_white is not None:
-            self.engine_thread_white.join()
-        self.engine_thread_white = threading.Thread(target=self.play_engine_move_white_thread)
-        self.engine_thread_white.start()
-
-    def play_engine_move_white_thread(self):
-        while self.board.turn == chess.WHITE and not self.board.is_game_over() and self.if_engine_vs_engine:
-            self.play_engine_move()
-
+        offset = self.save_game()
+        self.archive.flush()
+        print(f"Game saved to {self.archive.pgn_path} at offset {offset}")
+
+    def engine_failed(self):
+        return self.engine_loading.done() and self.engine_loading.exception() is not None
+
+    def engine_status(self):
+        if not self.engine_loading.done():
+            return "Loading engine..."
+        if self.engine_loading.exception() is not None:
+            return "Engine failed to load"
+        return "Engine ready"
+
+    def push_move(self, move):
+        if self.board.turn == chess.WHITE:
+            self.white_time += self.increment
+        else:
+            self.black_time += self.increment
+        self.board.push(move)
+        self.notation.append(move)
+        self.state_key = None
+
+    def is_engine_turn(self):
+        return self.if_engine_vs_engine or (self.if_engine and self.board.turn == chess.BLACK)
+
+    def update_engine(self):
+        if self.engine_future is None:
+            if self.is_engine_turn() and not self.position_state().is_game_over:
+                self.engine_request_fen = self.board.fen()
+                self.engine_request_time = time.perf_counter()
+                remaining = self.white_time if self.board.turn == chess.WHITE else self.black_time
+                self.engine_future = self.engine_worker.submit(self.board, self.engine_depth, remaining,
+                                                              self.increment)
+            return
+
+        if not self.engine_future.done():
+            return
+
+        PROFILER.record("engine_move", time.perf_counter() - self.engine_request_time)
+        future, self.engine_future = self.engine_future, None
+        if future.exception() is not None:
+            # The engine can't answer (e.g. the model failed to load): stop asking and hand its side to the player
+            print(f"Engine error: {future.exception()!r}")
+            self.if_engine = False
+            self.if_engine_vs_engine = False
+            return
+
+        move = future.result()
+        # Drop answers for a position that is no longer on the board
+        if move is not None and self.is_engine_turn() and self.board.fen() == self.engine_request_fen:
+            self.push_move(move)
+
+    def cancel_engine_move(self):
+        # A move that is already being computed finishes in the background and is discarded
+        if self.engine_future is not None:
+            self.engine_future.cancel()
+            self.engine_future = None
@@ -0,0 +1,124 @@
+import argparse
+from collections import Counter
+import chess
+import chess.pgn
+import chess.polyglot
+import numpy as np
+
+# Polyglot book entry: 16 big-endian bytes, sorted by key
+ENTRY_DTYPE = np.dtype([("key", ">u8"), ("move", ">u2"), ("weight", ">u2"), ("learn", ">u4")])
+
+# Polyglot writes castling as the king capturing its own rook
+CASTLING_TO_POLYGLOT = {
+    (chess.E1, chess.G1): chess.H1, (chess.E1, chess.C1): chess.A1,
+    (chess.E8, chess.G8): chess.H8, (chess.E8, chess.C8): chess.A8,
+}
+POLYGLOT_TO_CASTLING = {(from_square, rook): to_square
+                        for (from_square, to_square), rook in CASTLING_TO_POLYGLOT.items()}
+
+
+def encode_move(board, move):
+    to_square = move.to_square
+    if board.piece_type_at(move.from_square) == chess.KING:
+        to_square = CASTLING_TO_POLYGLOT.get((move.from_square, move.to_square), to_square)
+    promotion = move.promotion - 1 if move.promotion else 0
+    return (chess.square_file(to_square) | chess.square_rank(to_square) << 3 |
+            chess.square_file(move.from_square) << 6 | chess.square_rank(move.from_square) << 9 |
+            promotion << 12)
+
+
+def decode_move(board, raw):
+    to_square = chess.square(raw & 7, (raw >> 3) & 7)
+    from_square = chess.square((raw >> 6) & 7, (raw >> 9) & 7)
+    promotion = (raw >> 12) & 7
+    if board.piece_type_at(from_square) == chess.KING:
+        to_square = POLYGLOT_TO_CASTLING.get((from_square, to_square), to_square)
+    return chess.Move(from_square, to_square, promotion + 1 if promotion else None)
+
+
+def build_book(pgn_paths, output_path, max_plies=20, min_count=1):
+    # Count every (position, move) pair in the first `max_plies` plies of each game
+    counts = Counter()
+    for pgn_path in pgn_paths:
+        with open(pgn_path) as f:
+            while True:
+                game = chess.pgn.read_game(f)
+                if game is None:
+                    break
+                board = game.board()
+                for ply, move in enumerate(game.mainline_moves()):
+                    if ply >= max_plies:
+                        break
+                    counts[(chess.polyglot.zobrist_hash(board), encode_move(board, move))] += 1
+                    board.push(move)
+
+    entries = np.array([(key, move, min(count, 0xFFFF), 0) for (key, move), count in counts.items()
+                        if count >= min_count], dtype=ENTRY_DTYPE)
+    # Sorted by key, most played move first within a position
+    entries = entries[np.lexsort((-entries["weight"].astype(np.int64), entries["key"].astype(np.uint64)))]
+    entries.tofile(output_path)
+    return len(entries)
+
+
+class OpeningBook:
+    # Memory-mapped Polyglot book, so several engine processes share one copy in the page cache
+    def __init__(self, path):
+        self.entries = np.memmap(path, dtype=ENTRY_DTYPE, mode="r")
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, key):
+        # Binary search for the first entry with this key; only O(log n) entries are touched
+        lo, hi = 0, len(self.entries)
+        keys = self.entries["key"]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if int(keys[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        end = lo
+        while end < len(self.entries) and int(keys[end]) == key:
+            end += 1
+        return self.entries[lo:end]
+
+    def moves(self, board):
+        # (move, weight) for every legal book move in this position
+        result = []
+        for entry in self.find(chess.polyglot.zobrist_hash(board)):
+            move = decode_move(board, int(entry["move"]))
+            if board.is_legal(move):
+                result.append((move, int(entry["weight"])))
+        return result
+
+    def choose(self, board, rng=None):
+        # Most played move, or a weighted random pick when an rng is given
+        candidates = self.moves(board)
+        if not candidates:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if rng is None:
+            return max(candidates, key=lambda candidate: candidate[1])[0]
+        moves, weights = zip(*candidates)
+        if not any(weights):
+            return rng.choice(moves)
+        return rng.choices(moves, weights=weights)[0]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build a Polyglot opening book from PGN files")
+    parser.add_argument("pgn", nargs="+")
+    parser.add_argument("-o", "--output", default="book.bin")
+    parser.add_argument("--max-plies", type=int, default=20)
+    parser.add_argument("--min-count", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    count = build_book(args.pgn, args.output, args.max_plies, args.min_count)
+    print(f"Wrote {count} entries to {args.output}")
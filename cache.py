@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def to_sqlite_key(key):
+    # SQLite integers are signed 64-bit, Zobrist keys are unsigned
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+class PositionCache:
+    # Model outputs keyed by Zobrist hash: a bounded in-memory LRU in front of an optional
+    # SQLite file that survives restarts. Use one store per model, the keys don't say
+    # which network produced a prediction. An entry is a whole policy row, about 8 KB for the
+    # 2064 outputs, so the default 10000 entries take about 80 MB.
+    def __init__(self, maxsize=10000, path=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS predictions (key INTEGER PRIMARY KEY, prediction BLOB)")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def remember(self, key, prediction):
+        self.entries[key] = prediction
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def get_many(self, keys):
+        results = [None] * len(keys)
+        on_disk = []
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                prediction = self.entries.get(key)
+                if prediction is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    results[i] = prediction
+                else:
+                    on_disk.append(i)
+
+            if self.db is not None and on_disk:
+                wanted = {to_sqlite_key(keys[i]): i for i in on_disk}
+                rows = []
+                wanted_keys = list(wanted)
+                for start in range(0, len(wanted_keys), 500):
+                    chunk = wanted_keys[start:start + 500]
+                    rows += self.db.execute(
+                        f"SELECT key, prediction FROM predictions WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk).fetchall()
+                for db_key, blob in rows:
+                    i = wanted[db_key]
+                    results[i] = np.frombuffer(blob, dtype=np.float32)
+                    self.remember(keys[i], results[i])
+                    self.disk_hits += 1
+
+            self.misses += sum(result is None for result in results)
+
+        return results
+
+    def put_many(self, keys, predictions):
+        predictions = [np.asarray(prediction, dtype=np.float32) for prediction in predictions]
+        with self.lock:
+            for key, prediction in zip(keys, predictions):
+                self.remember(key, prediction)
+            if self.db is not None:
+                self.db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?)",
+                                    [(to_sqlite_key(key), prediction.tobytes())
+                                     for key, prediction in zip(keys, predictions)])
+                self.db.commit()
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put(self, key, prediction):
+        self.put_many([key], [prediction])
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {"size": len(self.entries), "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
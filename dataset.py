@@ -0,0 +1,133 @@
+import json
+import os
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {"fields": {}, "shards": []}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    # Write to a temporary file first so a crash never leaves a half-written manifest
+    tmp_path = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+
+
+def shard_file(path, index, field):
+    return os.path.join(path, f"{index:05d}_{field}.npy")
+
+
+class ShardWriter:
+    # Append-only writer: samples are buffered and written out as fixed-size .npy shards.
+    # A shard only becomes part of the dataset once the manifest lists it, so after a
+    # crash the writer picks up after the last complete shard.
+    def __init__(self, path, shard_size=65536):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_size = shard_size
+        self.manifest = read_manifest(path)
+        self.buffers = {}
+        self.buffered = 0
+
+    def __len__(self):
+        return sum(shard["size"] for shard in self.manifest["shards"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, **fields):
+        # Every field is an array with one row per sample, e.g. x=..., y=..., hash=...
+        sizes = {len(array) for array in fields.values()}
+        if len(sizes) != 1:
+            raise ValueError("All fields must have the same number of samples")
+        if self.manifest["fields"] and set(fields) != set(self.manifest["fields"]):
+            raise ValueError(f"Expected fields {sorted(self.manifest['fields'])}, got {sorted(fields)}")
+
+        for field, array in fields.items():
+            self.buffers.setdefault(field, []).append(np.asarray(array))
+        self.buffered += sizes.pop()
+
+        while self.buffered >= self.shard_size:
+            self.write_shard(self.shard_size)
+
+    def write_shard(self, size):
+        index = len(self.manifest["shards"])
+        for field, arrays in self.buffers.items():
+            data = np.concatenate(arrays)
+            tmp_path = shard_file(self.path, index, field) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, data[:size])
+            os.replace(tmp_path, shard_file(self.path, index, field))
+            self.buffers[field] = [data[size:]]
+            self.manifest["fields"][field] = {"dtype": data.dtype.str, "shape": list(data.shape[1:])}
+
+        self.buffered -= size
+        self.manifest["shards"].append({"index": index, "size": size})
+        write_manifest(self.path, self.manifest)
+
+    def close(self):
+        # Whatever is left becomes a final, shorter shard
+        if self.buffered:
+            self.write_shard(self.buffered)
+
+
+class ShardReader:
+    def __init__(self, path):
+        self.path = path
+        self.manifest = read_manifest(path)
+        self.fields = list(self.manifest["fields"])
+
+        # Shards are memory-mapped, so opening a dataset reads nothing but the headers
+        self.shards = [{field: np.load(shard_file(path, shard["index"], field), mmap_mode="r")
+                        for field in self.fields}
+                       for shard in self.manifest["shards"]]
+        self.offsets = np.cumsum([0] + [shard["size"] for shard in self.manifest["shards"]])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def dtype(self, field):
+        return np.dtype(self.manifest["fields"][field]["dtype"])
+
+    def shape(self, field):
+        return tuple(self.manifest["fields"][field]["shape"])
+
+    def take(self, indices):
+        indices = np.asarray(indices)
+        shard_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        batch = {field: np.empty((len(indices),) + self.shape(field), dtype=self.dtype(field))
+                 for field in self.fields}
+
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            local = indices[mask] - self.offsets[shard_id]
+            for field in self.fields:
+                batch[field][mask] = self.shards[shard_id][field][local]
+
+        return batch
+
+    def sample(self, batch_size, rng=None):
+        rng = rng or np.random.default_rng()
+        return self.take(rng.integers(0, len(self), batch_size))
+
+    def random_batches(self, batch_size, rng=None):
+        # One shuffled pass: shards in random order, samples shuffled within each shard,
+        # so only one shard's permutation is ever held in memory
+        rng = rng or np.random.default_rng()
+        for shard_id in rng.permutation(len(self.shards)):
+            shard = self.shards[shard_id]
+            order = rng.permutation(self.manifest["shards"][shard_id]["size"])
+            for start in range(0, len(order), batch_size):
+                local = np.sort(order[start:start + batch_size])
+                yield {field: np.asarray(shard[field][local]) for field in self.fields}
@@ -0,0 +1,135 @@
+import chess
+import numpy as np
+
+# Plane layout: 6 white piece planes (pawn..king), 6 black piece planes,
+# side to move, 4 castling planes (K, Q, k, q) and the en passant square
+NUM_PIECE_PLANES = 12
+TURN_PLANE = 12
+CASTLING_PLANE = 13
+EP_PLANE = 17
+NUM_PLANES = 18
+ENCODED_SIZE = NUM_PLANES * 64
+
+# Rook squares that carry each castling right, in plane order
+CASTLING_SQUARES = (chess.H1, chess.A1, chess.H8, chess.A8)
+
+
+def board_masks(board, masks):
+    # Fill one uint64 bitboard per plane straight from the python-chess board
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    pieces = (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings)
+
+    for i, bb in enumerate(pieces):
+        masks[i] = bb & white
+        masks[i + 6] = bb & black
+
+    masks[TURN_PLANE] = chess.BB_ALL if board.turn == chess.WHITE else 0
+    for i, square in enumerate(CASTLING_SQUARES):
+        masks[CASTLING_PLANE + i] = chess.BB_ALL if board.castling_rights & chess.BB_SQUARES[square] else 0
+    masks[EP_PLANE] = chess.BB_SQUARES[board.ep_square] if board.ep_square is not None else 0
+
+    return masks
+
+
+def unpack_masks(masks, out):
+    # Bit i of every bitboard becomes square i of its plane
+    bits = np.unpackbits(masks.astype("<u8").view(np.uint8), axis=-1, bitorder="little")
+    out[...] = bits.reshape(out.shape)
+    return out
+
+
+def encode_board(board, out=None):
+    if out is None:
+        out = np.zeros(ENCODED_SIZE, dtype=np.int8)
+    masks = board_masks(board, np.zeros(NUM_PLANES, dtype=np.uint64))
+    return unpack_masks(masks, out)
+
+
+def encode_boards(boards, out=None):
+    # Encode a batch of boards into one (len(boards), ENCODED_SIZE) buffer
+    if out is None:
+        out = np.zeros((len(boards), ENCODED_SIZE), dtype=np.int8)
+    masks = np.zeros((len(boards), NUM_PLANES), dtype=np.uint64)
+    for i, board in enumerate(boards):
+        board_masks(board, masks[i])
+    return unpack_masks(masks, out)
+
+
+def piece_plane(piece):
+    return piece.piece_type - 1 + (0 if piece.color == chess.WHITE else 6)
+
+
+class EncodedBoard:
+    # A chess.Board together with its encoding, kept in sync through push/pop. A move only
+    # touches the squares it changes (plus the small side-to-move, castling and en passant
+    # planes), so encoding inside a search tree costs O(1) per move instead of a full rebuild.
+    # `encoding` is "planes" (see encode_board) or "legacy" (ChessAI.encode_position's layout).
+    def __init__(self, board=None, encoding="planes"):
+        self.board = board.copy() if board is not None else chess.Board()
+        self.encoding = encoding
+        self.undo = []
+
+        if encoding == "planes":
+            self.array = encode_board(self.board)
+            self.planes = self.array.reshape(NUM_PLANES, 64)
+        else:
+            self.array = np.zeros(64, dtype=np.int8)
+            for square, piece in self.board.piece_map().items():
+                self.array[square] = piece.piece_type
+
+    def set_piece(self, square, old_piece, new_piece):
+        if self.encoding == "planes":
+            if old_piece is not None:
+                self.planes[piece_plane(old_piece), square] = 0
+            if new_piece is not None:
+                self.planes[piece_plane(new_piece), square] = 1
+        else:
+            self.array[square] = new_piece.piece_type if new_piece is not None else 0
+
+    def update_state_planes(self):
+        if self.encoding != "planes":
+            return
+        board = self.board
+        self.planes[TURN_PLANE] = board.turn == chess.WHITE
+        for i, square in enumerate(CASTLING_SQUARES):
+            self.planes[CASTLING_PLANE + i] = bool(board.castling_rights & chess.BB_SQUARES[square])
+        self.planes[EP_PLANE] = 0
+        if board.ep_square is not None:
+            self.planes[EP_PLANE, board.ep_square] = 1
+
+    def push(self, move):
+        board = self.board
+        moving = board.piece_at(move.from_square)
+        changes = [(move.from_square, moving, None)]
+
+        if board.is_en_passant(move):
+            captured_square = move.to_square + (-8 if board.turn == chess.WHITE else 8)
+            changes.append((captured_square, board.piece_at(captured_square), None))
+            changes.append((move.to_square, None, moving))
+        elif board.is_castling(move):
+            # python-chess castling moves go king to destination square; move the rook by hand
+            rank = chess.square_rank(move.from_square)
+            kingside = board.is_kingside_castling(move)
+            king_to = chess.square(6 if kingside else 2, rank)
+            rook_from = chess.square(7 if kingside else 0, rank) if not board.chess960 else move.to_square
+            rook_to = chess.square(5 if kingside else 3, rank)
+            rook = board.piece_at(rook_from)
+            changes = [(move.from_square, moving, None), (rook_from, rook, None),
+                       (king_to, None, moving), (rook_to, None, rook)]
+        else:
+            placed = chess.Piece(move.promotion, moving.color) if move.promotion else moving
+            changes.append((move.to_square, board.piece_at(move.to_square), placed))
+
+        for square, old_piece, new_piece in changes:
+            self.set_piece(square, old_piece, new_piece)
+        board.push(move)
+        self.update_state_planes()
+        self.undo.append(changes)
+
+    def pop(self):
+        for square, old_piece, new_piece in reversed(self.undo.pop()):
+            self.set_piece(square, new_piece, old_piece)
+        move = self.board.pop()
+        self.update_state_planes()
+        return move
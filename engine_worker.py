@@ -0,0 +1,140 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future
+from profiling import PROFILER, cprofile_session
+
+
+def serve(connection, profile_path=None):
+    # With `profile_path` the whole life of the engine process runs under cProfile
+    if profile_path is None:
+        serve_requests(connection)
+        return
+    with cprofile_session(profile_path):
+        serve_requests(connection)
+
+
+def serve_requests(connection):
+    # Loop of the engine process. Requests are (id, function, args, profile) and are answered in
+    # order with (id, result, exception, samples, counters); ("cancel", id) drops a queued request.
+    # Whatever the job recorded in this process's PROFILER is sent back with its answer.
+    pending = deque()
+    cancelled = set()
+    while True:
+        while not pending or connection.poll():
+            message = connection.recv()
+            if message is None:
+                return
+            if message[0] == "cancel":
+                cancelled.add(message[1])
+            else:
+                pending.append(message)
+
+        job_id, function, args, profile = pending.popleft()
+        if job_id in cancelled:
+            cancelled.discard(job_id)
+            continue
+
+        PROFILER.enabled = profile
+        result, error = None, None
+        try:
+            result = function(*args)
+        except Exception as e:
+            error = e
+        samples = {name: list(values) for name, values in PROFILER.samples.items()}
+        counters = dict(PROFILER.counters)
+        PROFILER.reset()
+        try:
+            connection.send((job_id, result, error, samples, counters))
+        except Exception as e:
+            # The result or exception couldn't be pickled
+            connection.send((job_id, None, RuntimeError(repr(e)), samples, counters))
+
+
+class EngineWorker:
+    # One long-lived process that answers move requests. Search is pure Python, so running it
+    # in a thread of the GUI process would hold the GIL and stall rendering; in its own process
+    # it only competes for a CPU. Every request gets a copy of the board and a future that a
+    # receiver thread completes, so the caller never blocks. Other jobs (like loading the model)
+    # can be queued with call() and run in the same process in order. Functions must be
+    # importable module-level functions, and any state they keep lives in the engine process.
+    # `profile_path` is where the engine process dumps its cProfile stats when stopped.
+    def __init__(self, choose_move, profile_path=None):
+        self.choose_move = choose_move
+        # A fresh interpreter rather than a fork of the GUI process and its display
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve, args=(child_connection, profile_path), name="engine-worker",
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+
+        self.futures = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.receiver = threading.Thread(target=self.receive, name="engine-receiver", daemon=True)
+        self.receiver.start()
+
+    def call(self, function, *args):
+        future = Future()
+        future.add_done_callback(self.forward_cancel)
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            future.job_id = job_id
+            self.futures[job_id] = future
+            self.connection.send((job_id, function, args, PROFILER.enabled))
+        return future
+
+    def submit(self, board, *args):
+        return self.call(self.choose_move, board.copy(), *args)
+
+    def forward_cancel(self, future):
+        # A request cancelled before it started is skipped by the engine process
+        if future.cancelled():
+            with self.lock:
+                if self.futures.pop(future.job_id, None) is not None:
+                    self.connection.send(("cancel", future.job_id))
+
+    def receive(self):
+        while True:
+            try:
+                job_id, result, error, samples, counters = self.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            for name, values in samples.items():
+                for seconds in values:
+                    PROFILER.record(name, seconds)
+            for name, amount in counters.items():
+                PROFILER.count(name, amount)
+
+            with self.lock:
+                future = self.futures.pop(job_id, None)
+            if future is None or not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        # The engine process is gone, nothing pending will be answered
+        with self.lock:
+            futures, self.futures = self.futures, {}
+        for future in futures.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("engine process exited"))
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            # Still busy with a long search
+            self.process.terminate()
+            self.process.join()
+        self.receiver.join()
+        self.connection.close()
@@ -0,0 +1,61 @@
+import json
+import h5py
+import numpy as np
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "tanh": np.tanh,
+}
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS["softmax"] = softmax
+
+
+class NumpyModel:
+    # Forward pass of a saved Keras Sequential model of Dense layers using plain NumPy matmuls.
+    # Mirrors the parts of the Keras model interface ChessAI uses (predict, input_shape).
+    def __init__(self, model_path):
+        self.layers = []
+        with h5py.File(model_path, "r") as f:
+            config = json.loads(f.attrs["model_config"])
+            weights = f["model_weights"]
+
+            for layer in config["config"]["layers"]:
+                if layer["class_name"] == "InputLayer":
+                    continue
+                if layer["class_name"] != "Dense":
+                    raise ValueError(f"Unsupported layer type for the NumPy backend: {layer['class_name']}")
+
+                name = layer["config"]["name"]
+                group = weights[name]
+                arrays = {}
+                for weight_name in group.attrs["weight_names"]:
+                    weight_name = weight_name.decode() if isinstance(weight_name, bytes) else weight_name
+                    arrays[weight_name.split("/")[-1].split(":")[0]] = np.array(group[weight_name], dtype=np.float32)
+
+                activation = layer["config"]["activation"]
+                if activation not in ACTIVATIONS:
+                    raise ValueError(f"Unsupported activation for the NumPy backend: {activation}")
+                self.layers.append((arrays["kernel"], arrays.get("bias"), ACTIVATIONS[activation]))
+
+        self.input_shape = (None, self.layers[0][0].shape[0])
+        self.output_shape = (None, self.layers[-1][0].shape[1])
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        for kernel, bias, activation in self.layers:
+            x = x @ kernel
+            if bias is not None:
+                x += bias
+            x = activation(x)
+        return x
+
+    def predict(self, x, batch_size=None):
+        return self(x)
@@ -0,0 +1,128 @@
+import argparse
+import io
+import os
+import time
+from collections import deque
+from multiprocessing import Pool
+import chess
+import chess.pgn
+import numpy as np
+from dataset import ShardWriter
+from encoding import EncodedBoard
+from moves import move_index
+from train import INPUT_SIZES
+
+# Game result from white's point of view; unfinished games ("*") are skipped
+RESULTS = {"1-0": 1, "0-1": -1, "1/2-1/2": 0}
+
+
+def game_chunks(pgn_paths, games_per_chunk=256):
+    # Split PGN files into text chunks of whole games without parsing them, reading one line
+    # at a time so memory doesn't grow with the file. A game starts at the first header line
+    # after some movetext.
+    for pgn_path in pgn_paths:
+        with open(pgn_path, encoding="utf-8", errors="replace") as f:
+            lines, games, in_movetext = [], 0, False
+            for line in f:
+                if line.startswith("["):
+                    if in_movetext:
+                        in_movetext = False
+                        games += 1
+                        if games == games_per_chunk:
+                            yield "".join(lines)
+                            lines, games = [], 0
+                elif line.strip():
+                    in_movetext = True
+                lines.append(line)
+            if lines:
+                yield "".join(lines)
+
+
+def parse_chunk(text, encoding="planes"):
+    # Every position of every finished game as (encoded position, played move index, result
+    # for the side to move), plus the number of games used
+    X, y, results = [], [], []
+    games = 0
+    pgn = io.StringIO(text)
+    while True:
+        game = chess.pgn.read_game(pgn)
+        if game is None:
+            break
+        result = RESULTS.get(game.headers.get("Result"))
+        if result is None or game.errors or type(game.board()) is not chess.Board:
+            continue
+
+        games += 1
+        position = EncodedBoard(game.board(), encoding)
+        for move in game.mainline_moves():
+            X.append(position.array.copy())
+            y.append(move_index(move))
+            results.append(result if position.board.turn == chess.WHITE else -result)
+            position.push(move)
+
+    X = np.array(X, dtype=np.int8).reshape(len(y), INPUT_SIZES[encoding])
+    return X, np.array(y, dtype=np.int16), np.array(results, dtype=np.int8), games
+
+
+def parse_chunks(pgn_paths, encoding="planes", workers=1, games_per_chunk=256, prefetch=None):
+    # Like stream_batches: at most `prefetch` chunks are in flight, so memory stays bounded
+    # no matter how large the input is
+    tasks = ((chunk, encoding) for chunk in game_chunks(pgn_paths, games_per_chunk))
+
+    if workers <= 1:
+        for task in tasks:
+            yield parse_chunk(*task)
+        return
+
+    prefetch = prefetch or 2 * workers
+    with Pool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(parse_chunk, task))
+            if len(pending) >= prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def ingest_pgn(pgn_paths, path, encoding="planes", workers=1, games_per_chunk=256, shard_size=64 * 1024,
+               report_every=10.0):
+    # Write x (encoded positions), y (played move index) and result fields to a sharded dataset
+    # that ChessAI.train(dataset=path) can read
+    start = last_report = time.perf_counter()
+    games = positions = 0
+
+    with ShardWriter(path, shard_size) as writer:
+        if len(writer):
+            raise ValueError(f"{path} already contains a dataset")
+        for X, y, results, chunk_games in parse_chunks(pgn_paths, encoding, workers, games_per_chunk):
+            if len(y):
+                writer.append(x=X, y=y, result=results)
+            games += chunk_games
+            positions += len(y)
+
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                print(f"{games} games, {positions} positions, {games / (now - start):.0f} games/sec")
+                last_report = now
+
+    seconds = time.perf_counter() - start
+    return {"games": games, "positions": positions, "seconds": seconds, "games_per_sec": games / seconds}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Turn PGN files into a sharded training dataset")
+    parser.add_argument("pgn", nargs="+")
+    parser.add_argument("--out", default="dataset")
+    parser.add_argument("--encoding", default="planes", choices=sorted(INPUT_SIZES))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--games-per-chunk", type=int, default=256)
+    parser.add_argument("--shard-size", type=int, default=64 * 1024)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    stats = ingest_pgn(args.pgn, args.out, args.encoding, args.workers, args.games_per_chunk, args.shard_size)
+    print(f"{stats['games']} games, {stats['positions']} positions in {stats['seconds']:.1f}s, "
+          f"{stats['games_per_sec']:.0f} games/sec")
@@ -1,5 +1,20 @@
+import argparse
 from board import ChessGame
+from profiling import cprofile_session
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Chess by Adam Pawlowski")
+    parser.add_argument("--profile", help="run the session under cProfile and dump the stats to this file")
+    parser.add_argument("--stats", help="export hot-path timings to this .json or .csv file on quit")
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
-    chess_game = ChessGame()
-    chess_game.run()
+    args = parse_args()
+    chess_game = ChessGame(stats_path=args.stats, profile_path=args.profile)
+    if args.profile:
+        with cprofile_session(args.profile):
+            chess_game.run()
+    else:
+        chess_game.run()
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import random
+import time
+from multiprocessing import Pool
+import chess
+import chess.pgn
+import numpy as np
+from archive import GameArchive, position_keys
+from search import SearchEngine
+from train import ChessAI
+
+# Engines of the current worker process, built once by init_worker
+ENGINES = {}
+
+
+class MatchEngine:
+    # One side of a match: a model plus optional alpha-beta search settings
+    def __init__(self, name, model_path, backend="numpy", depth=0, max_nodes=None, book_path=None,
+                 tablebase_dir=None, cache_size=0, cache_dir=None):
+        self.name = name
+        self.ai = ChessAI()
+        self.ai.load_model(model_path, backend=backend)
+        if cache_size:
+            # One SQLite file per engine, since its model may differ from the other engine's
+            self.ai.enable_cache(cache_size, os.path.join(cache_dir, name + ".sqlite") if cache_dir else None)
+        if book_path:
+            self.ai.load_book(book_path)
+        if tablebase_dir:
+            self.ai.load_tablebases(tablebase_dir)
+        self.search = SearchEngine(self.ai, depth, max_nodes) if depth else None
+
+    def choose_move(self, board):
+        if self.search is not None:
+            return self.search.search(board)
+        return self.ai.predict_move(board)
+
+
+def init_worker(configs):
+    for config in configs:
+        ENGINES[config["name"]] = MatchEngine(**config)
+
+
+def play_game(game_index, seed, names, opening_plies, max_plies):
+    # Even games give the first engine white, odd games swap colors
+    rng = random.Random(seed)
+    white, black = names if game_index % 2 == 0 else names[::-1]
+    board = ChessAI.random_board(opening_plies + 1, rng)
+    # Start every game with empty tables, so results don't depend on which worker played which games
+    for engine in ENGINES.values():
+        if engine.search is not None:
+            engine.search.tt.clear()
+    opening_length = len(board.move_stack)
+
+    while not board.is_game_over(claim_draw=True) and len(board.move_stack) < max_plies:
+        engine = ENGINES[white] if board.turn == chess.WHITE else ENGINES[black]
+        board.push(engine.choose_move(board))
+
+    # Games that hit the ply limit are adjudicated as draws
+    result = board.result(claim_draw=True)
+    if result == "*":
+        result = "1/2-1/2"
+
+    game = chess.pgn.Game.from_board(board)
+    game.headers["Event"] = "Engine match"
+    game.headers["Round"] = str(game_index + 1)
+    game.headers["White"] = white
+    game.headers["Black"] = black
+    game.headers["Result"] = result
+    game.headers["OpeningPlies"] = str(opening_length)
+
+    return {"game": game_index, "white": white, "black": black, "result": result,
+            "plies": len(board.move_stack), "pgn": str(game), "keys": position_keys(game)}
+
+
+def score(record, name):
+    # 1 for a win, 0.5 for a draw and 0 for a loss, from `name`'s point of view
+    if record["result"] == "1/2-1/2":
+        return 0.5
+    white_won = record["result"] == "1-0"
+    return 1.0 if white_won == (record["white"] == name) else 0.0
+
+
+def play_game_task(task):
+    return play_game(*task)
+
+
+def load_results(path):
+    # Records of the games already finished in an earlier run, by game index
+    finished = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line cut short when the run was killed
+                finished[record["game"]] = record
+    return finished
+
+
+def run_match(configs, games, workers=1, opening_plies=8, max_plies=400, seed=None, out_dir="matches"):
+    os.makedirs(out_dir, exist_ok=True)
+    names = [config["name"] for config in configs]
+    seeds = [int(game_seed) for game_seed in np.random.SeedSequence(seed).generate_state(games, dtype=np.uint64)]
+    results_path = os.path.join(out_dir, "results.jsonl")
+    stats = {"wins": 0, "draws": 0, "losses": 0}
+
+    def count(record):
+        points = score(record, names[0])
+        stats["wins" if points == 1 else "draws" if points == 0.5 else "losses"] += 1
+
+    # Games go to an indexed archive and results are appended as games finish, so a long run
+    # can be followed, and rerunning it with the same seed and out_dir resumes it: game indices
+    # already in results.jsonl are counted but not played again
+    finished = load_results(results_path)
+    for record in finished.values():
+        if record["game"] < games:
+            count(record)
+    tasks = [(i, seeds[i], names, opening_plies, max_plies) for i in range(games) if i not in finished]
+    resumed = games - len(tasks)
+    start = time.time()
+
+    with GameArchive(out_dir) as archive, \
+            open(results_path, "a") as results_file, \
+            Pool(workers, initializer=init_worker, initargs=(configs,)) as pool:
+        for done, record in enumerate(pool.imap_unordered(play_game_task, tasks), start=resumed + 1):
+            # Both are flushed after every game, so a killed run leaves no archived game that
+            # results.jsonl doesn't list and a resumed run doesn't play it again
+            archive.add(record.pop("pgn"), record.pop("keys"))
+            archive.flush()
+            results_file.write(json.dumps(record) + "\n")
+            results_file.flush()
+
+            count(record)
+            if done % 10 == 0 or done == games:
+                print(f"{done}/{games} games, {names[0]} vs {names[1]}: +{stats['wins']} ={stats['draws']} "
+                      f"-{stats['losses']} ({(done - resumed) / (time.time() - start):.2f} games/sec)")
+
+    stats["score"] = (stats["wins"] + 0.5 * stats["draws"]) / games if games else 0.0
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Play headless engine vs engine matches")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--model-a", default="chess_model.h5")
+    parser.add_argument("--model-b", default="chess_model.h5")
+    parser.add_argument("--backend", default="numpy", choices=["numpy", "keras", "remote"],
+                        help="remote: --model-a/--model-b are host:port of a serving.py server")
+    parser.add_argument("--depth-a", type=int, default=0, help="alpha-beta depth, 0 plays the raw model move")
+    parser.add_argument("--depth-b", type=int, default=0)
+    parser.add_argument("--max-nodes", type=int, default=None)
+    parser.add_argument("--book", default=None, help="Polyglot opening book used by both engines")
+    parser.add_argument("--tablebases", default=None, help="endgame table directory used by both engines")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="predictions each engine keeps in memory per worker, about 8 KB each; 0 disables the cache")
+    parser.add_argument("--cache", default=None, help="directory for each engine's persistent prediction cache")
+    parser.add_argument("--opening-plies", type=int, default=8)
+    parser.add_argument("--max-plies", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--out", default="matches")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cache:
+        os.makedirs(args.cache, exist_ok=True)
+    configs = [
+        {"name": "A", "model_path": args.model_a, "backend": args.backend, "depth": args.depth_a,
+         "max_nodes": args.max_nodes, "book_path": args.book, "tablebase_dir": args.tablebases,
+         "cache_size": args.cache_size, "cache_dir": args.cache},
+        {"name": "B", "model_path": args.model_b, "backend": args.backend, "depth": args.depth_b,
+         "max_nodes": args.max_nodes, "book_path": args.book, "tablebase_dir": args.tablebases,
+         "cache_size": args.cache_size, "cache_dir": args.cache},
+    ]
+    stats = run_match(configs, args.games, args.workers, args.opening_plies, args.max_plies, args.seed, args.out)
+    print(f"A vs B: +{stats['wins']} ={stats['draws']} -{stats['losses']}, score {stats['score']:.3f}")
@@ -0,0 +1,77 @@
+import chess
+import numpy as np
+
+# Size of the network's policy output. Only the first NUM_MOVES slots are mapped to moves.
+POLICY_SIZE = 2064
+
+PROMOTION_PIECES = (chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN)
+
+
+def is_queen_or_knight_move(from_square, to_square):
+    file_distance = abs(chess.square_file(from_square) - chess.square_file(to_square))
+    rank_distance = abs(chess.square_rank(from_square) - chess.square_rank(to_square))
+    if from_square == to_square:
+        return False
+    if file_distance == 0 or rank_distance == 0 or file_distance == rank_distance:
+        return True
+    return {file_distance, rank_distance} == {1, 2}
+
+
+def is_promotion_move(from_square, to_square):
+    file_distance = abs(chess.square_file(from_square) - chess.square_file(to_square))
+    from_rank, to_rank = chess.square_rank(from_square), chess.square_rank(to_square)
+    return file_distance <= 1 and ((from_rank, to_rank) == (6, 7) or (from_rank, to_rank) == (1, 0))
+
+
+def build_move_table():
+    # Every (from, to, promotion) a legal chess move can have, in a fixed order:
+    # all queen and knight geometry moves first, then the pawn promotions
+    moves = [chess.Move(from_square, to_square)
+             for from_square in chess.SQUARES for to_square in chess.SQUARES
+             if is_queen_or_knight_move(from_square, to_square)]
+    moves += [chess.Move(from_square, to_square, promotion)
+              for from_square in chess.SQUARES for to_square in chess.SQUARES
+              if is_promotion_move(from_square, to_square)
+              for promotion in PROMOTION_PIECES]
+
+    # Lookup by [from_square, to_square, promotion piece type or 0], -1 where no move exists
+    index_table = np.full((64, 64, 7), -1, dtype=np.int16)
+    for index, move in enumerate(moves):
+        index_table[move.from_square, move.to_square, move.promotion or 0] = index
+
+    return moves, index_table
+
+
+INDEX_TO_MOVE, MOVE_INDEX_TABLE = build_move_table()
+NUM_MOVES = len(INDEX_TO_MOVE)
+
+
+def move_index(move):
+    return int(MOVE_INDEX_TABLE[move.from_square, move.to_square, move.promotion or 0])
+
+
+def move_indices(moves):
+    squares = np.array([(move.from_square, move.to_square, move.promotion or 0) for move in moves],
+                       dtype=np.intp).reshape(-1, 3)
+    return MOVE_INDEX_TABLE[squares[:, 0], squares[:, 1], squares[:, 2]]
+
+
+def index_move(index):
+    return INDEX_TO_MOVE[index]
+
+
+def select_moves(predictions, legal_moves):
+    # Masked argmax over a batch: every output that isn't a legal move of its board is
+    # pushed to -inf, and the best remaining index in each row is that board's move
+    if not legal_moves:
+        return []
+    predictions = np.asarray(predictions).reshape(len(legal_moves), -1)
+    rows = np.concatenate([np.full(len(moves), i, dtype=np.intp) for i, moves in enumerate(legal_moves)] + [[]])
+    columns = np.concatenate([move_indices(moves) for moves in legal_moves] + [[]])
+    rows, columns = rows.astype(np.intp), columns.astype(np.intp)
+
+    masked = np.full(predictions.shape, -np.inf, dtype=np.float32)
+    masked[rows, columns] = predictions[rows, columns]
+    best = masked.argmax(axis=1)
+
+    return [INDEX_TO_MOVE[index] if moves else None for index, moves in zip(best, legal_moves)]
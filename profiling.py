@@ -0,0 +1,105 @@
+import cProfile
+import csv
+import json
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+
+# Shared no-op context manager handed out while profiling is off
+NULL_TIMER = nullcontext()
+
+
+class Timer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+
+
+class Profiler:
+    # Named timers and counters for the hot paths. While disabled, timer() returns a shared
+    # no-op context manager and count() returns straight away, so instrumentation can stay in.
+    def __init__(self, enabled=False, max_samples=1000):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        self.samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def timer(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        self.samples[name].append(seconds)
+        self.totals[name] += seconds
+        self.calls[name] += 1
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] += amount
+
+    def percentiles(self, name, percents=(50, 90, 99)):
+        # Percentiles in milliseconds over the most recent samples
+        samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return {}
+        return {p: samples[min(len(samples) - 1, len(samples) * p // 100)] * 1000 for p in percents}
+
+    def summary(self):
+        timers = {}
+        for name in self.calls:
+            timers[name] = {"calls": self.calls[name], "total_ms": self.totals[name] * 1000,
+                            "mean_ms": self.totals[name] * 1000 / self.calls[name]}
+            timers[name].update({f"p{p}_ms": value for p, value in self.percentiles(name).items()})
+        return {"timers": timers, "counters": dict(self.counters)}
+
+    def export_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def export_csv(self, path):
+        summary = self.summary()
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "calls", "total_ms", "mean_ms", "p50_ms", "p90_ms", "p99_ms"])
+            for name, timer in summary["timers"].items():
+                writer.writerow([name, timer["calls"], timer["total_ms"], timer["mean_ms"],
+                                 timer.get("p50_ms"), timer.get("p90_ms"), timer.get("p99_ms")])
+            for name, value in summary["counters"].items():
+                writer.writerow([name, value, "", "", "", "", ""])
+
+    def export(self, path):
+        if path.endswith(".csv"):
+            self.export_csv(path)
+        else:
+            self.export_json(path)
+
+
+# Process-wide profiler used by ChessAI and ChessGame
+PROFILER = Profiler()
+
+
+@contextmanager
+def cprofile_session(path):
+    # Run the enclosed code under cProfile and dump the stats to `path` (readable with pstats)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
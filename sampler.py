@@ -0,0 +1,210 @@
+import argparse
+import random
+import time
+import chess
+import chess.polyglot
+import numpy as np
+from dataset import ShardWriter
+from train import INPUT_SIZES, ChessAI
+
+# Game phase from the non-pawn material left on the board, counted like a tapered evaluation:
+# 1 per minor piece, 2 per rook, 4 per queen, 24 at the start
+PHASES = ("opening", "middlegame", "endgame")
+PHASE_WEIGHTS = {chess.KNIGHT: 1, chess.BISHOP: 1, chess.ROOK: 2, chess.QUEEN: 4}
+
+
+def game_phase(board):
+    material = sum(weight * chess.popcount(board.pieces_mask(piece_type, chess.WHITE) |
+                                           board.pieces_mask(piece_type, chess.BLACK))
+                   for piece_type, weight in PHASE_WEIGHTS.items())
+    if material >= 20:
+        return 0
+    return 1 if material > 8 else 2
+
+
+def random_move(board, rng):
+    # Uniform over the legal moves without building the legal move list: draw pseudo-legal
+    # moves until one doesn't leave the king in check. None when there is no legal move.
+    moves = list(board.generate_pseudo_legal_moves())
+    while moves:
+        i = rng.randrange(len(moves))
+        move = moves[i]
+        if not board.is_into_check(move):
+            return move
+        moves[i] = moves[-1]
+        moves.pop()
+    return None
+
+
+def quotas(count, weights):
+    # Largest share of `count` each bucket may take, never less than its fair part
+    weights = np.asarray(weights, dtype=np.float64)
+    return np.ceil(count * weights / weights.sum()).astype(np.int64)
+
+
+class PositionSampler:
+    # Random-playout positions that are all different: every position is checked against a
+    # set of the Zobrist keys already handed out, across calls. One playout yields several
+    # positions, one per ply whose bucket still needs some.
+    # `depth_weights` is the target share of positions per ply (0..max_depth-1, uniform like
+    # ChessAI.random_board by default) and `phase_weights` per game phase (see PHASES, no
+    # preference by default). When the targets can't be met, e.g. with max_depth=3 there are
+    # only 421 positions, the sampler gives up on them after `patience` playouts without a new
+    # position and takes any new position instead, except at plies and phases whose weight is 0;
+    # after `patience` more the stream ends.
+    def __init__(self, max_depth=100, depth_weights=None, phase_weights=None, seed=None, patience=1000):
+        self.max_depth = max_depth
+        self.depth_weights = np.ones(max_depth) if depth_weights is None else np.asarray(depth_weights)
+        if len(self.depth_weights) != max_depth:
+            raise ValueError(f"Expected {max_depth} depth weights, got {len(self.depth_weights)}")
+        if isinstance(phase_weights, dict):
+            phase_weights = [phase_weights.get(phase, 0) for phase in PHASES]
+        self.phase_weights = phase_weights
+        self.rng = random.Random(seed)
+        self.patience = patience
+        self.seen = set()
+        self.playouts = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.seen)
+
+    def chunks(self, count, chunk_size=1024):
+        # Yield (boards, keys) lists of up to `chunk_size` positions until `count` new positions
+        # were produced
+        depth_quota = quotas(count, self.depth_weights)
+        phase_quota = quotas(count, self.phase_weights) if self.phase_weights is not None else None
+        depth_count = np.zeros(self.max_depth, dtype=np.int64)
+        phase_count = np.zeros(len(PHASES), dtype=np.int64)
+        # Buckets that may still be filled once the quotas are dropped
+        depth_allowed = self.depth_weights > 0
+        phase_allowed = np.asarray(self.phase_weights) > 0 if self.phase_weights is not None \
+            else np.ones(len(PHASES), dtype=bool)
+        strict = True
+        idle = produced = 0
+        chunk, keys = [], []
+
+        while produced < count and idle < self.patience:
+            # Play no further than the deepest ply that still takes positions
+            open_depths = np.flatnonzero(depth_count < depth_quota) if strict else np.flatnonzero(depth_allowed)
+            if not len(open_depths):
+                if not strict:
+                    break
+                strict, idle = False, 0
+                continue
+
+            board = chess.Board()
+            found = 0
+            for ply in range(open_depths[-1] + 1):
+                if ply:
+                    move = random_move(board, self.rng)
+                    if move is None:
+                        break
+                    board.push(move)
+                if strict and depth_count[ply] >= depth_quota[ply] or not depth_allowed[ply]:
+                    continue
+                phase = game_phase(board)
+                if strict and phase_quota is not None and phase_count[phase] >= phase_quota[phase] or \
+                        not phase_allowed[phase]:
+                    continue
+
+                key = chess.polyglot.zobrist_hash(board)
+                if key in self.seen:
+                    self.duplicates += 1
+                    continue
+                self.seen.add(key)
+                depth_count[ply] += 1
+                phase_count[phase] += 1
+                chunk.append(board.copy(stack=False))
+                keys.append(key)
+                found += 1
+                produced += 1
+                if len(chunk) == chunk_size:
+                    yield chunk, keys
+                    chunk, keys = [], []
+                if produced == count:
+                    break
+
+            self.playouts += 1
+            idle = 0 if found else idle + 1
+            if strict and idle >= self.patience:
+                strict, idle = False, 0
+
+        if chunk:
+            yield chunk, keys
+
+    def sample(self, count):
+        return [board for boards, _ in self.chunks(count, count) for board in boards]
+
+    def stats(self):
+        return {"positions": len(self.seen), "playouts": self.playouts, "duplicates": self.duplicates,
+                "positions_per_playout": len(self.seen) / self.playouts if self.playouts else 0.0}
+
+
+def sample_batches(num_samples, batch_size, max_depth, encoding="planes", seed=None, depth_weights=None,
+                   phase_weights=None, sampler=None):
+    # Like stream_batches, but every position is new: (X, y, hashes) batches of unique positions.
+    # The seen-key set has to be shared, so positions come from one process.
+    if sampler is None:
+        sampler = PositionSampler(max_depth, depth_weights, phase_weights, seed)
+    chess_ai = ChessAI(encoding)
+    rng = random.Random(seed)
+    for boards, keys in sampler.chunks(num_samples, batch_size):
+        X = chess_ai.encode_positions(boards, np.zeros((len(boards), INPUT_SIZES[encoding]), dtype=np.int8))
+        y = np.array([rng.random() for _ in boards], dtype=np.float32)  # Placeholder evaluation
+        yield X, y, np.array(keys, dtype=np.uint64)
+
+
+def build_unique_dataset(path, num_samples, max_depth, encoding="planes", seed=None, depth_weights=None,
+                         phase_weights=None, batch_size=1024, shard_size=64 * 1024, report_every=10.0):
+    # Same fields as build_dataset (x, y, hash), with no position stored twice
+    sampler = PositionSampler(max_depth, depth_weights, phase_weights, seed)
+    start = last_report = time.perf_counter()
+    positions = 0
+
+    with ShardWriter(path, shard_size) as writer:
+        if len(writer):
+            raise ValueError(f"{path} already contains a dataset")
+        for X, y, hashes in sample_batches(num_samples, batch_size, max_depth, encoding, seed, sampler=sampler):
+            writer.append(x=X, y=y, hash=hashes)
+            positions += len(y)
+
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                print(f"{positions} positions, {positions / (now - start):.0f} positions/sec")
+                last_report = now
+
+    stats = sampler.stats()
+    stats["seconds"] = time.perf_counter() - start
+    stats["positions_per_sec"] = positions / stats["seconds"]
+    return stats
+
+
+def parse_weights(text):
+    # "1,2,2,1" -> [1.0, 2.0, 2.0, 1.0]
+    return [float(weight) for weight in text.split(",")] if text else None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write a dataset of unique random positions")
+    parser.add_argument("--samples", type=int, default=1000000)
+    parser.add_argument("--max-depth", type=int, default=100)
+    parser.add_argument("--depth-weights", default=None, help="comma-separated weight per ply, default uniform")
+    parser.add_argument("--phase-weights", default=None,
+                        help="comma-separated weights for " + ",".join(PHASES) + ", default any phase")
+    parser.add_argument("--encoding", default="planes", choices=sorted(INPUT_SIZES))
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--out", default="positions")
+    parser.add_argument("--shard-size", type=int, default=64 * 1024)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    stats = build_unique_dataset(args.out, args.samples, args.max_depth, args.encoding, args.seed,
+                                 parse_weights(args.depth_weights), parse_weights(args.phase_weights),
+                                 shard_size=args.shard_size)
+    print(f"{stats['positions']} unique positions from {stats['playouts']} playouts in {stats['seconds']:.1f}s, "
+          f"{stats['positions_per_sec']:.0f} positions/sec ({stats['duplicates']} duplicates skipped)")
+    if stats["positions"] < args.samples:
+        print(f"Stopped early: random playouts of up to {args.max_depth} plies stopped finding new positions")
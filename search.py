@@ -0,0 +1,344 @@
+import time
+import chess
+import chess.polyglot
+import numpy as np
+from encoding import EncodedBoard
+
+PIECE_VALUES = {chess.PAWN: 100, chess.KNIGHT: 320, chess.BISHOP: 330, chess.ROOK: 500, chess.QUEEN: 900}
+MATE_SCORE = 100000
+MATE_BOUND = MATE_SCORE - 1000
+INFINITY = MATE_SCORE + 1
+MAX_DEPTH = 64
+
+# Transposition table bound types
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+
+class SearchAborted(Exception):
+    pass
+
+
+class TranspositionTable:
+    # Fixed-size table indexed by the low bits of the Zobrist key. Search results and
+    # model priors are kept in separate slots so a leaf never evicts an interior node.
+    def __init__(self, size=1 << 18):
+        self.size = size
+        self.entries = [None] * size
+        self.policies = [None] * size
+        self.hits = 0
+        self.probes = 0
+
+    def probe(self, key):
+        self.probes += 1
+        entry = self.entries[key % self.size]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        return None
+
+    def store(self, key, depth, value, flag, move):
+        # Prefer keeping the deeper result for the same position
+        slot = key % self.size
+        entry = self.entries[slot]
+        if entry is None or entry[0] != key or depth >= entry[1]:
+            self.entries[slot] = (key, depth, value, flag, move)
+
+    def probe_policy(self, key):
+        policy = self.policies[key % self.size]
+        if policy is not None and policy[0] == key:
+            return policy
+        return None
+
+    def store_policy(self, key, moves, scores):
+        self.policies[key % self.size] = (key, moves, scores)
+
+    def clear(self):
+        self.entries = [None] * self.size
+        self.policies = [None] * self.size
+        self.hits = 0
+        self.probes = 0
+
+
+def material(board):
+    # Material balance in centipawns from the side to move's point of view
+    score = 0
+    for piece_type, value in PIECE_VALUES.items():
+        pieces = board.pieces_mask(piece_type, chess.WHITE), board.pieces_mask(piece_type, chess.BLACK)
+        score += value * (chess.popcount(pieces[0]) - chess.popcount(pieces[1]))
+    return score if board.turn == chess.WHITE else -score
+
+
+def to_tt(value, ply):
+    # Mate scores are stored relative to the node so they stay valid when reached by another path
+    if value > MATE_BOUND:
+        return value + ply
+    if value < -MATE_BOUND:
+        return value - ply
+    return value
+
+
+def from_tt(value, ply):
+    if value > MATE_BOUND:
+        return value - ply
+    if value < -MATE_BOUND:
+        return value + ply
+    return value
+
+
+class TimeManager:
+    # Splits the remaining clock into per-move budgets. A reserve of `safety_margin` of the
+    # clock (and at least `min_reserve` seconds) is never spent, and no single move may use
+    # more than `max_fraction` of what is left. Iterative deepening stops starting new
+    # iterations after `soft_fraction` of the budget, since the next one would rarely finish.
+    def __init__(self, moves_to_go=30, safety_margin=0.05, min_reserve=1.0, max_fraction=0.25,
+                 soft_fraction=0.5):
+        self.moves_to_go = moves_to_go
+        self.safety_margin = safety_margin
+        self.min_reserve = min_reserve
+        self.max_fraction = max_fraction
+        self.soft_fraction = soft_fraction
+
+    def budget(self, remaining, increment=0.0):
+        # Seconds to spend on this move
+        usable = max(0.0, remaining - max(self.min_reserve, remaining * self.safety_margin))
+        return min(usable / self.moves_to_go + 0.75 * increment, usable * self.max_fraction)
+
+    def deadlines(self, remaining, increment=0.0, start=None):
+        # (soft, hard) deadlines on the time.perf_counter() clock
+        start = time.perf_counter() if start is None else start
+        budget = self.budget(remaining, increment)
+        return start + self.soft_fraction * budget, start + budget
+
+
+class SearchEngine:
+    # Iterative-deepening alpha-beta on top of a ChessAI model. The network only has a
+    # policy head, so it orders moves, and a leaf is scored as material plus
+    # `policy_weight` times the network's confidence in its best move there.
+    def __init__(self, ai, depth=3, max_nodes=None, tt_size=1 << 18, policy_weight=50, time_manager=None):
+        self.ai = ai
+        self.depth = depth
+        self.max_nodes = max_nodes
+        self.policy_weight = policy_weight
+        self.tt = TranspositionTable(tt_size)
+        self.time_manager = time_manager or TimeManager()
+        self.deadline = None
+        self.node_limit = max_nodes
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nodes = 0
+        self.model_calls = 0
+        self.positions_evaluated = 0
+        self.tt.hits = 0
+        self.tt.probes = 0
+
+    def store_predictions(self, keys, legal_moves, encoded):
+        # One batched forward pass over already-encoded positions, cached as move priors. Positions
+        # the AI's prediction cache already knows skip the model. Model calls are the slow part,
+        # so the deadline is checked before every one.
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise SearchAborted()
+        self.model_calls += 1
+        self.positions_evaluated += len(keys)
+        predictions = self.ai.predict_encoded(np.stack(encoded), keys)
+        policies = []
+        for key, moves, prediction in zip(keys, legal_moves, predictions):
+            scores = self.ai.move_scores(prediction, moves) if moves else np.zeros(0)
+            if key is not None:
+                self.tt.store_policy(key, moves, scores)
+            policies.append((key, moves, scores))
+        return policies
+
+    def policy(self, position, key):
+        policy = self.tt.probe_policy(key)
+        if policy is None:
+            policy = self.store_predictions([key], [list(position.board.legal_moves)], [position.array])[0]
+        return policy
+
+    def evaluate(self, board, scores):
+        confidence = float(scores.max()) if len(scores) else 0.0
+        return material(board) + int(self.policy_weight * confidence)
+
+    def prefetch_children(self, position, moves):
+        # Children of a depth-1 node are all leaves: score them in a single model call
+        keys, legal_moves, encoded = [], [], []
+        for move in moves:
+            position.push(move)
+            key = chess.polyglot.zobrist_hash(position.board)
+            if self.tt.probe_policy(key) is None:
+                keys.append(key)
+                legal_moves.append(list(position.board.legal_moves))
+                encoded.append(position.array.copy())
+            position.pop()
+        if keys:
+            self.store_predictions(keys, legal_moves, encoded)
+
+    def check_limits(self):
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchAborted()
+        if self.deadline is not None and self.nodes % 256 == 0 and time.perf_counter() >= self.deadline:
+            raise SearchAborted()
+
+    def negamax(self, position, depth, alpha, beta, ply):
+        # `position` is an EncodedBoard, so moves made here update the network input incrementally
+        board = position.board
+        self.nodes += 1
+        self.check_limits()
+
+        if ply > 0 and (board.is_insufficient_material() or board.halfmove_clock >= 100 or board.is_repetition(2)):
+            return 0, None
+
+        key = chess.polyglot.zobrist_hash(board)
+        alpha_orig = alpha
+        tt_move = None
+        entry = self.tt.probe(key)
+        if entry is not None:
+            _, entry_depth, entry_value, flag, tt_move = entry
+            entry_value = from_tt(entry_value, ply)
+            if entry_depth >= depth and ply > 0:
+                if flag == EXACT:
+                    return entry_value, tt_move
+                if flag == LOWER:
+                    alpha = max(alpha, entry_value)
+                elif flag == UPPER:
+                    beta = min(beta, entry_value)
+                if alpha >= beta:
+                    return entry_value, tt_move
+
+        _, moves, scores = self.policy(position, key)
+        if not moves:
+            return (-MATE_SCORE + ply if board.is_check() else 0), None
+        if depth == 0:
+            return self.evaluate(board, scores), None
+
+        # Transposition table move first, then the rest by model probability
+        order = [moves[i] for i in np.argsort(-scores, kind="stable")]
+        if tt_move in moves:
+            order.remove(tt_move)
+            order.insert(0, tt_move)
+        if depth == 1:
+            self.prefetch_children(position, order)
+
+        best_value, best_move = -INFINITY, None
+        for move in order:
+            position.push(move)
+            try:
+                value = -self.negamax(position, depth - 1, -beta, -alpha, ply + 1)[0]
+            finally:
+                position.pop()
+            if value > best_value:
+                best_value, best_move = value, move
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best_value <= alpha_orig:
+            flag = UPPER
+        elif best_value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, to_tt(best_value, ply), flag, best_move)
+        return best_value, best_move
+
+    def search(self, board, depth=None, max_nodes=None, deadline=None, soft_deadline=None):
+        # Deepen one ply at a time and keep the result of the last completed iteration. No new
+        # iteration starts after `soft_deadline`; `deadline` aborts the one in progress.
+        if board.is_game_over():
+            return None
+        depth = depth or self.depth
+        # Per-call limits, the constructor's max_nodes stays the default for later searches
+        self.node_limit = max_nodes if max_nodes is not None else self.max_nodes
+        self.deadline = deadline
+        self.reset_stats()
+        self.completed_depth = 0
+
+        known_move = self.ai.known_move(board)
+        if known_move is not None:
+            return known_move
+
+        position = EncodedBoard(board, self.ai.encoding)
+        best_move = None
+        for current_depth in range(1, depth + 1):
+            if soft_deadline is not None and current_depth > 1 and time.perf_counter() >= soft_deadline:
+                break
+            try:
+                value, move = self.negamax(position, current_depth, -INFINITY, INFINITY, 0)
+            except SearchAborted:
+                break
+            if move is not None:
+                best_move = move
+                self.completed_depth = current_depth
+            if abs(value) > MATE_BOUND:
+                break  # A forced mate either way won't change with more depth
+
+        if best_move is None:
+            # Not even depth 1 finished: fall back to the network's own choice
+            self.deadline = None
+            _, moves, scores = self.policy(position, chess.polyglot.zobrist_hash(position.board))
+            best_move = moves[int(np.argmax(scores))]
+        return best_move
+
+    def think(self, board, remaining, increment=0.0):
+        # Anytime search on a clock: `remaining` and `increment` in seconds for the side to move.
+        # Searches as deep as the move's budget allows and answers by the hard deadline.
+        if board.is_game_over():
+            return None
+        moves = list(board.legal_moves)
+        if len(moves) == 1:
+            return moves[0]
+        soft_deadline, deadline = self.time_manager.deadlines(remaining, increment)
+        return self.search(board, MAX_DEPTH, deadline=deadline, soft_deadline=soft_deadline)
+
+
+class MinimaxSearch(SearchEngine):
+    # Plain fixed-depth minimax with the same leaf evaluation and no table, pruning or
+    # batching. Only used as the baseline that SearchEngine's model call count is measured against.
+    def policy(self, position, key):
+        # Every node goes to the model, nothing is cached
+        return self.store_predictions([None], [list(position.board.legal_moves)], [position.array])[0]
+
+    def prefetch_children(self, position, moves):
+        pass
+
+    def negamax(self, position, depth, alpha, beta, ply):
+        self.nodes += 1
+
+        _, moves, scores = self.policy(position, None)
+        if not moves:
+            return (-MATE_SCORE + ply if position.board.is_check() else 0), None
+        if depth == 0:
+            return self.evaluate(position.board, scores), None
+
+        best_value, best_move = -INFINITY, None
+        for move in moves:
+            position.push(move)
+            value = -self.negamax(position, depth - 1, -INFINITY, INFINITY, ply + 1)[0]
+            position.pop()
+            if value > best_value:
+                best_value, best_move = value, move
+        return best_value, best_move
+
+    def search(self, board, depth=None, max_nodes=None, deadline=None):
+        if board.is_game_over():
+            return None
+        self.reset_stats()
+        position = EncodedBoard(board, self.ai.encoding)
+        return self.negamax(position, depth or self.depth, -INFINITY, INFINITY, 0)[1]
+
+
+def compare_with_minimax(ai, boards, depth=2):
+    # Model calls and positions evaluated per chosen move for both searches
+    results = {}
+    for name, engine in (("alphabeta", SearchEngine(ai, depth)), ("minimax", MinimaxSearch(ai, depth))):
+        calls = positions = nodes = 0
+        for board in boards:
+            engine.search(board)
+            calls += engine.model_calls
+            positions += engine.positions_evaluated
+            nodes += engine.nodes
+        results[name] = {"model_calls": calls / len(boards), "positions_evaluated": positions / len(boards),
+                         "nodes": nodes / len(boards)}
+    return results
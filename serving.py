@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import Pool
+import numpy as np
+from inference import NumpyModel
+
+# Wire format: every message is a header (dtype code, rows, columns) followed by the raw array.
+# On connect the server sends one header-only message with the model's input and output widths.
+HEADER = struct.Struct("<cII")
+
+
+def start_request(future):
+    # False for a request that was cancelled while queued; takes concurrent and asyncio futures
+    if isinstance(future, Future):
+        return future.set_running_or_notify_cancel()
+    return not future.cancelled()
+
+
+class BatchingModel:
+    # Shares one warm model between many callers, so a machine holds one copy of it instead of
+    # one per game. Requests from any thread are queued on an asyncio loop running in a
+    # background thread and gathered into batches of up to `max_batch_size` rows. The model
+    # runs on one executor thread, so requests pile up into the next batch while this one runs;
+    # `max_wait` seconds of extra waiting only pays off for models with a high fixed cost per
+    # call, like Keras predict(). A predict() call that finds the model idle and nothing queued
+    # runs it straight away on the calling thread instead.
+    # predict() and input_shape make it a drop-in model for ChessAI.
+    def __init__(self, model, max_batch_size=256, max_wait=0.0):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.input_shape = model.input_shape
+        self.output_shape = model.output_shape
+        self.batches = 0
+        self.positions = 0
+        self.servers = []
+        self.model_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = 0  # Requests submitted from other threads and not yet taken into a batch
+
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="model")
+        self.loop = asyncio.new_event_loop()
+        self.queue = None
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), name="batching-model", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        self.batcher = self.loop.create_task(self.batch_loop())
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def submit(self, x):
+        # Queue one or more rows from any thread; the Future resolves to their predictions
+        future = Future()
+        with self.pending_lock:
+            self.pending += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (np.asarray(x), future))
+        return future
+
+    def predict(self, x, batch_size=None):
+        # With no other callers the thread hop to the batcher costs more than it saves
+        if self.pending == 0 and self.model_lock.acquire(blocking=False):
+            try:
+                if self.pending == 0:
+                    return self.run_model(np.asarray(x))
+            finally:
+                self.model_lock.release()
+        return self.submit(x).result()
+
+    def run_model(self, batch):
+        # Called with model_lock held
+        predictions = self.model.predict(batch)
+        self.batches += 1
+        self.positions += len(batch)
+        return predictions
+
+    def run_batch(self, batch):
+        with self.model_lock:
+            return self.run_model(batch)
+
+    async def batch_loop(self):
+        while True:
+            requests = [await self.queue.get()]
+            size = len(requests[0][0])
+            deadline = self.loop.time() + self.max_wait
+            # A lone request goes straight to the model; only wait for a batch to fill when
+            # other callers are active, since under load requests pile up while the model runs
+            waiting = not self.queue.empty()
+            while size < self.max_batch_size:
+                if self.queue.empty():
+                    if not waiting:
+                        break
+                    timeout = deadline - self.loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self.queue.get_nowait()
+                requests.append(request)
+                size += len(request[0])
+
+            taken = sum(isinstance(future, Future) for _, future in requests)
+            with self.pending_lock:
+                self.pending -= taken
+            requests = [(x, future) for x, future in requests if start_request(future)]
+            if not requests:
+                continue
+            try:
+                batch = np.concatenate([x for x, _ in requests])
+                predictions = await self.loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for x, future in requests:
+                future.set_result(predictions[start:start + len(x)])
+                start += len(x)
+
+    def stats(self):
+        return {"batches": self.batches, "positions": self.positions,
+                "mean_batch_size": self.positions / self.batches if self.batches else 0.0}
+
+    def start_server(self, host="127.0.0.1", port=5555):
+        # Serve this model to other processes (see RemoteModel) from the same event loop
+        server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle_connection, host, port), self.loop).result()
+        self.servers.append(server)
+        return server
+
+    async def handle_connection(self, reader, writer):
+        writer.write(HEADER.pack(b"f", self.input_shape[-1], self.output_shape[-1]))
+        try:
+            while True:
+                code, rows, columns = HEADER.unpack(await reader.readexactly(HEADER.size))
+                dtype = np.dtype(code.decode())
+                x = np.frombuffer(await reader.readexactly(rows * columns * dtype.itemsize), dtype=dtype)
+                # Already on the loop, so the request skips the thread-safe queueing of submit()
+                future = self.loop.create_future()
+                self.queue.put_nowait((x.reshape(rows, columns), future))
+                predictions = await future
+                predictions = np.ascontiguousarray(predictions, dtype=np.float32)
+                writer.write(HEADER.pack(b"f", *predictions.shape) + predictions.tobytes())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # Client went away or the server is shutting down
+        finally:
+            writer.close()
+
+    async def shutdown(self):
+        # Stop serving, then cancel the batcher and open connections before the loop stops
+        for server in self.servers:
+            server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Inference server closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+class RemoteModel:
+    # Client for a BatchingModel served with start_server, usable wherever ChessAI expects a model
+    def __init__(self, address):
+        host, port = address.rsplit(":", 1)
+        self.sock = socket.create_connection((host, int(port)))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+        _, input_size, output_size = HEADER.unpack(receive_exactly(self.sock, HEADER.size))
+        self.input_shape = (None, input_size)
+        self.output_shape = (None, output_size)
+
+    def predict(self, x, batch_size=None):
+        x = np.ascontiguousarray(x)
+        with self.lock:
+            self.sock.sendall(HEADER.pack(x.dtype.char.encode(), *x.shape) + x.tobytes())
+            _, rows, columns = HEADER.unpack(receive_exactly(self.sock, HEADER.size))
+            data = receive_exactly(self.sock, rows * columns * 4)
+        return np.frombuffer(data, dtype=np.float32).reshape(rows, columns)
+
+    def close(self):
+        self.sock.close()
+
+
+def measure_throughput(model, clients, requests_per_client=200, seed=0):
+    # Positions/sec with `clients` threads each asking for one position at a time
+    rng = np.random.default_rng(seed)
+    inputs = rng.integers(0, 2, (clients, 1, model.input_shape[-1]), dtype=np.int8)
+
+    def client(i):
+        for _ in range(requests_per_client):
+            model.predict(inputs[i])
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * requests_per_client / (time.perf_counter() - start)
+
+
+def process_client(model_path, address, requests_per_client, seed):
+    # One engine process asking for one position at a time, from its own model or a server
+    model = NumpyModel(model_path) if address is None else RemoteModel(address)
+    x = np.random.default_rng(seed).integers(0, 2, (1, model.input_shape[-1]), dtype=np.int8)
+    model.predict(x)
+    start = time.perf_counter()
+    for _ in range(requests_per_client):
+        model.predict(x)
+    return start, time.perf_counter()
+
+
+def measure_processes(model_path, clients, address=None, requests_per_client=500):
+    # Positions/sec of `clients` processes, each loading its own model or, with `address`,
+    # sharing a served one: the real alternative to one model per engine process
+    with Pool(clients) as pool:
+        spans = pool.starmap(process_client, [(model_path, address, requests_per_client, i) for i in range(clients)])
+    return clients * requests_per_client / (max(end for _, end in spans) - min(start for start, _ in spans))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve one batched model to local engine processes")
+    parser.add_argument("--model", default="chess_model.h5")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--max-wait", type=float, default=0.0, help="seconds to wait for a batch to fill")
+    parser.add_argument("--measure", action="store_true",
+                        help="compare direct and batched throughput, in threads and in processes, and exit")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    model = NumpyModel(args.model)
+    batching = BatchingModel(model, args.max_batch_size, args.max_wait)
+
+    if args.measure:
+        for clients in (1, 4, 16, 64):
+            direct = measure_throughput(model, clients)
+            batched = measure_throughput(batching, clients)
+            print(f"{clients:3} threads: direct {direct:10.0f} positions/sec, batched {batched:10.0f} positions/sec")
+        batching.start_server(args.host, args.port)
+        address = f"{args.host}:{args.port}"
+        for clients in (1, 4, 16):
+            direct = measure_processes(args.model, clients)
+            served = measure_processes(args.model, clients, address)
+            print(f"{clients:3} processes: own model {direct:10.0f} positions/sec, "
+                  f"served {served:10.0f} positions/sec")
+        print(batching.stats())
+        batching.close()
+    else:
+        batching.start_server(args.host, args.port)
+        print(f"Serving {args.model} on {args.host}:{args.port}")
+        try:
+            batching.thread.join()
+        except KeyboardInterrupt:
+            batching.close()
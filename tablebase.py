@@ -0,0 +1,440 @@
+import argparse
+import os
+import struct
+import time
+from collections import defaultdict
+from itertools import combinations_with_replacement, product
+from multiprocessing import Pool
+import chess
+import numpy as np
+
+# Table file: a 16 byte header followed by one int8 per position. A position that is won
+# in n plies is stored as n + 1, lost in n plies as -(n + 1), draws as 0. Positions that
+# can't occur (overlapping pieces, side not to move in check, ...) are ILLEGAL.
+HEADER = struct.Struct("<4sHH8s")
+MAGIC = b"EGTB"
+VERSION = 1
+ILLEGAL = -128
+EXTENSION = ".egtb"
+
+# Order of the non-king pieces in a material name, strongest first
+PIECE_ORDER = (chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT, chess.PAWN)
+PROMOTIONS = (chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT)
+
+
+def side_name(piece_types):
+    return "K" + "".join(chess.piece_symbol(piece_type).upper()
+                         for piece_type in sorted(piece_types, key=PIECE_ORDER.index))
+
+
+def side_strength(piece_types):
+    return len(piece_types), sorted(-PIECE_ORDER.index(piece_type) for piece_type in piece_types)
+
+
+def material_name(white_types, black_types):
+    # Tables are only stored with the stronger side as white; `swapped` says the colors were exchanged
+    if side_strength(white_types) >= side_strength(black_types):
+        return side_name(white_types) + "v" + side_name(black_types), False
+    return side_name(black_types) + "v" + side_name(white_types), True
+
+
+def parse_material(name):
+    # "KRvKP" -> [(WHITE, KING), (WHITE, ROOK), (BLACK, KING), (BLACK, PAWN)]
+    pieces = []
+    for color, side in zip((chess.WHITE, chess.BLACK), name.split("v")):
+        pieces.extend((color, chess.PIECE_SYMBOLS.index(symbol.lower())) for symbol in side)
+    return pieces
+
+
+def parent_value(value):
+    # Value of a position from the value of the position a move leads to
+    if value == 0:
+        return 0
+    return -value + 1 if value < 0 else -value - 1
+
+
+def better(value, other):
+    # Shorter wins beat longer wins beat draws beat longer losses beat shorter losses
+    def rank(v):
+        return (2, -v) if v > 0 else (1, 0) if v == 0 else (0, -v)
+    return other is None or rank(value) > rank(other)
+
+
+def piece_attacks(piece_type, color, square, occupied):
+    if piece_type == chess.PAWN:
+        return chess.BB_PAWN_ATTACKS[color][square]
+    if piece_type == chess.KNIGHT:
+        return chess.BB_KNIGHT_ATTACKS[square]
+    if piece_type == chess.KING:
+        return chess.BB_KING_ATTACKS[square]
+    attacks = 0
+    if piece_type in (chess.BISHOP, chess.QUEEN):
+        attacks |= chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+    if piece_type in (chess.ROOK, chess.QUEEN):
+        attacks |= (chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied] |
+                    chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied])
+    return attacks
+
+
+def attacked(pieces, squares, by_color, target, occupied):
+    for (color, piece_type), square in zip(pieces, squares):
+        if color == by_color and square is not None and \
+                piece_attacks(piece_type, color, square, occupied) & chess.BB_SQUARES[target]:
+            return True
+    return False
+
+
+def occupancy(squares):
+    occupied = 0
+    for square in squares:
+        if square is not None:
+            occupied |= chess.BB_SQUARES[square]
+    return occupied
+
+
+class Table:
+    # Index of a position: side to move, then the white king folded onto files a-d (every
+    # position has a left-right mirror image, there is no castling), then 64 squares per
+    # remaining piece. Identical pieces are kept in ascending square order.
+    def __init__(self, name, values=None):
+        self.name = name
+        self.pieces = parse_material(name)
+        self.size = 2 * 32 * 64 ** (len(self.pieces) - 1)
+        self.kings = {color: self.pieces.index((color, chess.KING)) for color in chess.COLORS}
+        self.runs = []
+        start = 0
+        for end in range(1, len(self.pieces) + 1):
+            if end == len(self.pieces) or self.pieces[end] != self.pieces[start]:
+                if end - start > 1:
+                    self.runs.append((start, end))
+                start = end
+        self.values = values
+
+    def index(self, squares, turn):
+        if squares[0] & 7 >= 4:
+            squares = [square ^ 7 for square in squares]
+        elif self.runs:
+            squares = list(squares)
+        for start, end in self.runs:
+            squares[start:end] = sorted(squares[start:end])
+        king = squares[0]
+        index = (0 if turn == chess.WHITE else 1) * 32 + (king >> 3) * 4 + (king & 7)
+        for square in squares[1:]:
+            index = index * 64 + square
+        return index
+
+    def squares(self, index):
+        squares = []
+        for _ in range(len(self.pieces) - 1):
+            index, square = divmod(index, 64)
+            squares.append(square)
+        index, king = divmod(index, 32)
+        squares.append((king >> 2) * 8 + (king & 3))
+        return squares[::-1], index == 0
+
+    def positions(self):
+        # (index, squares, turn) for every canonical placement, in index order
+        index = 0
+        for turn in (chess.WHITE, chess.BLACK):
+            for king in range(32):
+                king_square = (king >> 2) * 8 + (king & 3)
+                for rest in product(range(64), repeat=len(self.pieces) - 1):
+                    yield index, (king_square,) + rest, turn
+                    index += 1
+
+    def valid(self, squares):
+        if len(set(squares)) < len(squares):
+            return False
+        for start, end in self.runs:
+            if list(squares[start:end]) != sorted(squares[start:end]):
+                return False
+        for (color, piece_type), square in zip(self.pieces, squares):
+            if piece_type == chess.PAWN and square >> 3 in (0, 7):
+                return False
+        return True
+
+    def moves(self, squares, turn):
+        # Legal moves as (moving piece, new squares, captured piece or None, promotion piece types or None)
+        occupied = occupancy(squares)
+        own = occupancy(square for (color, _), square in zip(self.pieces, squares) if color == turn)
+        for i, (color, piece_type) in enumerate(self.pieces):
+            if color != turn:
+                continue
+            square = squares[i]
+            if piece_type == chess.PAWN:
+                targets = piece_attacks(piece_type, color, square, occupied) & occupied & ~own
+                step = 8 if color == chess.WHITE else -8
+                if not occupied & chess.BB_SQUARES[square + step]:
+                    targets |= chess.BB_SQUARES[square + step]
+                    if square >> 3 == (1 if color == chess.WHITE else 6) and \
+                            not occupied & chess.BB_SQUARES[square + 2 * step]:
+                        targets |= chess.BB_SQUARES[square + 2 * step]
+            else:
+                targets = piece_attacks(piece_type, color, square, occupied) & ~own
+
+            for target in chess.scan_forward(targets):
+                moved = list(squares)
+                moved[i] = target
+                captured = None
+                if occupied & chess.BB_SQUARES[target]:
+                    captured = squares.index(target)
+                    moved[captured] = None
+                king = moved[self.kings[turn]]
+                if attacked(self.pieces, moved, not turn, king, occupancy(moved)):
+                    continue
+                promotions = PROMOTIONS if piece_type == chess.PAWN and target >> 3 in (0, 7) else None
+                yield i, moved, captured, promotions
+
+    def predecessors(self, squares, turn):
+        # Indices of positions that reach this one by a quiet move that stays in the table
+        mover = not turn
+        occupied = occupancy(squares)
+        for i, (color, piece_type) in enumerate(self.pieces):
+            if color != mover:
+                continue
+            square = squares[i]
+            if piece_type == chess.PAWN:
+                origins = []
+                back = -8 if color == chess.WHITE else 8
+                if 8 <= square + back < 56 and not occupied & chess.BB_SQUARES[square + back]:
+                    origins.append(square + back)
+                    if square >> 3 == (3 if color == chess.WHITE else 4) and \
+                            not occupied & chess.BB_SQUARES[square + 2 * back]:
+                        origins.append(square + 2 * back)
+            else:
+                origins = chess.scan_forward(piece_attacks(piece_type, color, square, occupied) & ~occupied)
+
+            for origin in origins:
+                previous = list(squares)
+                previous[i] = origin
+                # With `mover` to move, the other king must not be in check
+                if attacked(self.pieces, previous, mover, previous[self.kings[turn]],
+                            occupied ^ chess.BB_SQUARES[square] ^ chess.BB_SQUARES[origin]):
+                    continue
+                yield self.index(previous, mover)
+
+
+def load_table(path):
+    with open(path, "rb") as f:
+        magic, version, _, name = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} endgame table")
+    table = Table(name.rstrip(b"\0").decode())
+    table.values = np.memmap(path, dtype=np.int8, mode="r", offset=HEADER.size, shape=(table.size,))
+    return table
+
+
+def write_table(table, values, directory):
+    path = os.path.join(directory, table.name + EXTENSION)
+    with open(path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(table.pieces), table.name.encode()))
+        values.tofile(f)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+class EndgameTables:
+    # Memory-mapped tables in `directory`, loaded on first use
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}
+        names = [f[:-len(EXTENSION)] for f in os.listdir(directory) if f.endswith(EXTENSION)] \
+            if os.path.isdir(directory) else []
+        self.available = set(names)
+        self.max_pieces = max((len(parse_material(name)) for name in names), default=0)
+        self.hits = 0
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = load_table(os.path.join(self.directory, name + EXTENSION))
+        return self.tables[name]
+
+    def probe_pieces(self, pieces, squares, turn):
+        # Stored value for pieces [(color, piece_type), ...] on `squares`, None without a table
+        white = [piece_type for (color, piece_type) in pieces if color == chess.WHITE and piece_type != chess.KING]
+        black = [piece_type for (color, piece_type) in pieces if color == chess.BLACK and piece_type != chess.KING]
+        if not white and not black:
+            return 0
+        name, swapped = material_name(white, black)
+        if name not in self.available:
+            return None
+        if swapped:
+            pieces = [(not color, piece_type) for color, piece_type in pieces]
+            squares = [square ^ 56 for square in squares]
+            turn = not turn
+
+        placed = defaultdict(list)
+        for piece, square in zip(pieces, squares):
+            placed[piece].append(square)
+        table = self.table(name)
+        ordered = [placed[piece].pop() for piece in table.pieces]
+        return int(table.values[table.index(ordered, turn)])
+
+    def probe(self, board):
+        # Tables assume no castling rights and no en passant capture
+        if chess.popcount(board.occupied) > self.max_pieces or board.castling_rights or \
+                board.has_legal_en_passant():
+            return None
+        piece_map = board.piece_map()
+        pieces = [(piece.color, piece.piece_type) for piece in piece_map.values()]
+        return self.probe_pieces(pieces, list(piece_map), board.turn)
+
+    def wdl(self, board):
+        # 1 win, 0 draw, -1 loss for the side to move
+        value = self.probe(board)
+        return None if value is None else (value > 0) - (value < 0)
+
+    def dtm(self, board):
+        # Plies until mate with best play, None for draws
+        value = self.probe(board)
+        return None if not value else abs(value) - 1
+
+    def best_move(self, board):
+        # Quickest mate when winning, longest resistance when losing
+        if self.probe(board) is None:
+            return None
+        best, best_value = None, None
+        for move in board.legal_moves:
+            board.push(move)
+            value = self.probe(board)
+            board.pop()
+            if value is None:
+                continue
+            value = parent_value(value)
+            if better(value, best_value):
+                best, best_value = move, value
+        if best is not None:
+            self.hits += 1
+        return best
+
+
+def generate_table(name, directory):
+    # Retrograde analysis: start from mates and work backwards through un-moves, counting
+    # for every position how many of its moves are still unresolved. Captures and
+    # promotions leave the table and are looked up in the tables generated before it.
+    start = time.perf_counter()
+    table = Table(name)
+    tables = EndgameTables(directory)
+    values = np.full(table.size, ILLEGAL, dtype=np.int8)
+    resolved = np.ones(table.size, dtype=bool)
+    counts = np.zeros(table.size, dtype=np.uint8)
+    loss_plies = np.zeros(table.size, dtype=np.uint8)
+    blocked = np.zeros(table.size, dtype=bool)  # Has a move that avoids losing
+    solved = defaultdict(list)  # Plies to mate -> positions solved at that distance
+    exit_wins = defaultdict(list)  # Plies to mate -> positions that win through a capture or promotion
+
+    for index, squares, turn in table.positions():
+        if not table.valid(squares):
+            continue
+        if attacked(table.pieces, squares, turn, squares[table.kings[not turn]], occupancy(squares)):
+            continue
+
+        children = set()
+        exit_best = None
+        has_moves = False
+        for i, moved, captured, promotions in table.moves(squares, turn):
+            has_moves = True
+            if captured is None and promotions is None:
+                children.add(table.index(moved, not turn))
+                continue
+            for promotion in promotions or (None,):
+                child = [((color, promotion if j == i and promotion else piece_type), square)
+                         for j, ((color, piece_type), square) in enumerate(zip(table.pieces, moved))
+                         if square is not None]
+                value = tables.probe_pieces([piece for piece, _ in child], [square for _, square in child], not turn)
+                if value is None:
+                    raise ValueError(f"{name} needs a table that hasn't been generated yet")
+                value = parent_value(value)
+                if better(value, exit_best):
+                    exit_best = value
+
+        values[index] = 0
+        if not has_moves:
+            # Checkmate or stalemate
+            if attacked(table.pieces, squares, not turn, squares[table.kings[turn]], occupancy(squares)):
+                values[index] = -1
+                solved[0].append(index)
+            continue
+        if exit_best is not None:
+            if exit_best > 0:
+                exit_wins[exit_best - 1].append(index)
+            if exit_best >= 0:
+                blocked[index] = True
+            else:
+                loss_plies[index] = -exit_best - 1
+        if not children:
+            values[index] = exit_best
+            if exit_best:
+                solved[abs(exit_best) - 1].append(index)
+            continue
+        counts[index] = len(children)
+        resolved[index] = False
+
+    plies = 0
+    while solved or exit_wins:
+        for index in exit_wins.pop(plies, ()):
+            if not resolved[index]:
+                values[index] = plies + 1
+                resolved[index] = True
+                solved[plies].append(index)
+        for index in solved.pop(plies, ()):
+            squares, turn = table.squares(index)
+            won = values[index] > 0
+            for previous in set(table.predecessors(squares, turn)):
+                if resolved[previous]:
+                    continue
+                if not won:
+                    values[previous] = plies + 2
+                    resolved[previous] = True
+                    solved[plies + 1].append(previous)
+                    continue
+                counts[previous] -= 1
+                loss_plies[previous] = max(loss_plies[previous], plies + 1)
+                if counts[previous] == 0 and not blocked[previous]:
+                    values[previous] = -(int(loss_plies[previous]) + 1)
+                    resolved[previous] = True
+                    solved[int(loss_plies[previous])].append(previous)
+        plies += 1
+        if plies > 125:
+            raise ValueError(f"{name}: distance to mate does not fit in int8")
+
+    path = write_table(table, values, directory)
+    return name, path, time.perf_counter() - start
+
+
+def table_names(max_pieces):
+    # Every material with 3..max_pieces pieces, ordered so a table's captures and promotions come first
+    names = set()
+    for count in range(3, max_pieces + 1):
+        for white_count in range(count - 1):
+            for white in combinations_with_replacement(PIECE_ORDER, white_count):
+                for black in combinations_with_replacement(PIECE_ORDER, count - 2 - white_count):
+                    names.add(material_name(white, black)[0])
+    return sorted(names, key=lambda name: (len(name) - 1, name.count("P"), name))
+
+
+def generate_tables(directory, max_pieces=4, workers=1):
+    # Tables with the same piece and pawn count don't depend on each other and run in parallel
+    os.makedirs(directory, exist_ok=True)
+    groups = defaultdict(list)
+    for name in table_names(max_pieces):
+        if not os.path.exists(os.path.join(directory, name + EXTENSION)):
+            groups[(len(name) - 1, name.count("P"))].append(name)
+
+    with Pool(workers) as pool:
+        for key in sorted(groups):
+            for name, path, seconds in pool.starmap(generate_table, [(name, directory) for name in groups[key]]):
+                print(f"{name}: {seconds:.1f}s -> {path}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate endgame tables by retrograde analysis")
+    parser.add_argument("--max-pieces", type=int, default=4, choices=[3, 4])
+    parser.add_argument("--out", default="tablebases")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate_tables(args.out, args.max_pieces, args.workers)
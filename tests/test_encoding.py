@@ -0,0 +1,62 @@
+import random
+import chess
+import numpy as np
+import pytest
+from encoding import EncodedBoard, encode_board
+from train import ChessAI
+
+# Castling both ways, en passant, promotions with and without capture
+SPECIAL_FENS = [
+    chess.STARTING_FEN,
+    "r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1",
+    "r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1",
+    "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+    "rnbqkbnr/pppp1ppp/8/8/3Pp3/8/PPP1PPPP/RNBQKBNR b KQkq d3 0 3",
+    "1n2k3/P6P/8/8/8/8/p6p/1N2K3 w - - 0 1",
+    "1n2k3/P6P/8/8/8/8/p6p/1N2K3 b - - 0 1",
+]
+
+
+def expected(board, encoding):
+    return encode_board(board) if encoding == "planes" else ChessAI.encode_position(board)
+
+
+def walk(position, encoding, rng, plies):
+    # Random moves pushed and popped on an EncodedBoard, checked against a full encode after each
+    stack = []
+    for _ in range(plies):
+        moves = list(position.board.legal_moves)
+        if moves and (not stack or rng.random() < 0.8):
+            position.push(rng.choice(moves))
+            stack.append(position.board.fen())
+        elif stack:
+            position.pop()
+            stack.pop()
+        else:
+            break
+        np.testing.assert_array_equal(position.array, expected(position.board, encoding), position.board.fen())
+
+
+@pytest.mark.parametrize("encoding", ["planes", "legacy"])
+@pytest.mark.parametrize("fen", SPECIAL_FENS)
+def test_every_move_and_undo(fen, encoding):
+    position = EncodedBoard(chess.Board(fen), encoding)
+    before = position.array.copy()
+    for move in list(position.board.legal_moves):
+        position.push(move)
+        np.testing.assert_array_equal(position.array, expected(position.board, encoding), move.uci())
+        position.pop()
+        np.testing.assert_array_equal(position.array, before, move.uci())
+
+
+@pytest.mark.parametrize("encoding", ["planes", "legacy"])
+def test_random_walks(encoding):
+    rng = random.Random(0)
+    for _ in range(20):
+        walk(EncodedBoard(chess.Board(), encoding), encoding, rng, 300)
+
+
+def test_chess960_castling():
+    rng = random.Random(1)
+    for scharnagl in (0, 518, 959):
+        walk(EncodedBoard(chess.Board.from_chess960_pos(scharnagl)), "planes", rng, 200)
@@ -0,0 +1,55 @@
+import random
+import chess
+import numpy as np
+from moves import INDEX_TO_MOVE, NUM_MOVES, POLICY_SIZE, index_move, move_index, move_indices, select_moves
+
+# Positions with castling, en passant and every kind of promotion among the legal moves
+SPECIAL_FENS = [
+    "r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1",
+    "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+    "1n2k3/P6P/8/8/8/8/p6p/1N2K3 w - - 0 1",
+    "1n2k3/P6P/8/8/8/8/p6p/1N2K3 b - - 0 1",
+]
+
+
+def sample_boards(count=300, seed=0):
+    rng = random.Random(seed)
+    boards = [chess.Board(fen) for fen in SPECIAL_FENS]
+    for _ in range(count):
+        board = chess.Board()
+        for _ in range(rng.randrange(200)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        boards.append(board)
+    return boards
+
+
+def test_table_is_a_bijection():
+    assert NUM_MOVES <= POLICY_SIZE
+    assert len(set(INDEX_TO_MOVE)) == NUM_MOVES
+    for index in range(NUM_MOVES):
+        assert move_index(index_move(index)) == index
+
+
+def test_every_legal_move_has_an_index():
+    for board in sample_boards():
+        moves = list(board.legal_moves)
+        indices = move_indices(moves)
+        assert (indices >= 0).all(), board.fen()
+        assert len(set(indices.tolist())) == len(moves), board.fen()
+        for move, index in zip(moves, indices):
+            assert index_move(int(index)) == move
+
+
+def test_select_moves_is_the_best_legal_move():
+    rng = np.random.default_rng(0)
+    boards = sample_boards(100, seed=1)
+    legal_moves = [list(board.legal_moves) for board in boards]
+    predictions = rng.random((len(boards), POLICY_SIZE), dtype=np.float32)
+    for moves, prediction, selected in zip(legal_moves, predictions, select_moves(predictions, legal_moves)):
+        if not moves:
+            assert selected is None
+        else:
+            assert selected == max(moves, key=lambda move: prediction[move_index(move)])
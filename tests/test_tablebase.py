@@ -0,0 +1,65 @@
+import random
+import chess
+import pytest
+from tablebase import EndgameTables, better, generate_table, parent_value, table_names
+
+
+@pytest.fixture(scope="module")
+def tables(tmp_path_factory):
+    # Only the 3-piece tables, the 4-piece ones take minutes each
+    directory = str(tmp_path_factory.mktemp("tablebases"))
+    for name in table_names(3):
+        generate_table(name, directory)
+    return EndgameTables(directory)
+
+
+def random_position(rng, name):
+    # A legal position with the pieces of `name` on random squares, or None
+    board = chess.Board(None)
+    for color, side in zip((chess.WHITE, chess.BLACK), name.split("v")):
+        for symbol in side:
+            piece = chess.Piece.from_symbol(symbol if color == chess.WHITE else symbol.lower())
+            board.set_piece_at(rng.choice(chess.SQUARES), piece)
+    board.turn = rng.choice(chess.COLORS)
+    if len(board.piece_map()) != len(name) - 1 or not board.is_valid():
+        return None
+    return board
+
+
+def recompute(tables, board):
+    # Value of `board` from the stored values of the positions one ply later
+    if board.is_checkmate():
+        return -1
+    best = None
+    for move in board.legal_moves:
+        board.push(move)
+        value = parent_value(tables.probe(board))
+        board.pop()
+        if better(value, best):
+            best = value
+    return 0 if best is None else best
+
+
+def test_values_agree_with_one_ply_search(tables):
+    rng = random.Random(0)
+    checked = 0
+    for name in sorted(tables.available):
+        for _ in range(3000):
+            board = random_position(rng, name)
+            if board is None:
+                continue
+            assert tables.probe(board) == recompute(tables, board), board.fen()
+            checked += 1
+    assert checked > 10000
+
+
+def test_longest_mates(tables):
+    # Known longest mates, in moves: KQvK 10, KRvK 16; a lone minor piece never wins
+    def longest_mate(name):
+        # A win in n plies is stored as n + 1
+        return int(tables.table(name).values.max()) // 2
+
+    assert longest_mate("KQvK") == 10
+    assert longest_mate("KRvK") == 16
+    assert longest_mate("KBvK") == 0
+    assert longest_mate("KNvK") == 0
@@ -1,49 +1,123 @@
+import os
 import random
 from datetime import datetime
+from collections import deque
+import multiprocessing
+from multiprocessing import shared_memory
 import chess
+import chess.polyglot
 import numpy as np
-from keras.models import Sequential, load_model
-from keras.layers import Dense
+from book import OpeningBook
+from cache import PositionCache
+from dataset import ShardReader, ShardWriter
+from encoding import ENCODED_SIZE, encode_boards
+from inference import NumpyModel
+from moves import POLICY_SIZE, move_indices, select_moves
+from profiling import PROFILER
+from tablebase import EndgameTables
+
+# Input size of the network for each position encoding
+INPUT_SIZES = {"legacy": 64, "planes": ENCODED_SIZE}
 
 
 class ChessAI:
-    def __init__(self):
+    def __init__(self, encoding="planes"):
         self.model = None
+        self.encoding = encoding
+        self.cache = None
+        self.book = None
+        self.tablebases = None
+
+    def build_model(self, loss='mse'):
+        # TensorFlow is only imported for training and the Keras backend, inference can run without it
+        from keras.layers import Dense
+        from keras.models import Sequential
 
-    def train(self, num_samples=10, max_depth=100):
-        X_train = []
-        y_train = []
+        model = Sequential()
+        model.add(Dense(32, activation='relu', input_shape=(INPUT_SIZES[self.encoding],)))
+        model.add(Dense(POLICY_SIZE, activation='softmax'))  # Output a probability distribution over moves
 
-        for _ in range(num_samples):
-            position = self.random_board(max_depth)
-            encoded_position = self.encode_position(position)
-            evaluation = random.random()  # Placeholder evaluation
-            X_train.append(encoded_position)
-            y_train.append(evaluation)
+        model.compile(optimizer='adam', loss=loss)
+        return model
 
-        X_train = np.array(X_train)
-        y_train = np.array(y_train)
+    def train(self, num_samples=10, max_depth=100, workers=1, seed=None, streaming=False, batch_size=1024,
+              dataset=None):
+        import tensorflow as tf
 
-        model = Sequential()
-        model.add(Dense(32, activation='relu', input_shape=(64,)))
-        model.add(Dense(2064, activation='softmax'))  # Output a probability distribution over moves
+        reader = ShardReader(dataset) if dataset is not None else None
+        if reader is not None:
+            # The dataset fixes the input width, whatever encoding this ChessAI was created with
+            self.encoding = "planes" if reader.shape("x")[-1] == ENCODED_SIZE else "legacy"
+        # Datasets from ingest.py label positions with the played move's index instead of a float score
+        sparse = reader is not None and np.issubdtype(reader.dtype("y"), np.integer)
+        model = self.build_model('sparse_categorical_crossentropy' if sparse else 'mse')
 
-        model.compile(optimizer='adam', loss='mse')
-        model.fit(X_train, y_train, epochs=10)
+        if reader is not None:
+            # Read shuffled batches from a memory-mapped dataset written by build_dataset or ingest.py
+            rng = np.random.default_rng(seed)
+            signature = (tf.TensorSpec((None,) + reader.shape("x"), tf.as_dtype(reader.dtype("x"))),
+                         tf.TensorSpec((None,), tf.as_dtype(reader.dtype("y"))))
+            batches = tf.data.Dataset.from_generator(
+                lambda: ((batch["x"], batch["y"]) for batch in reader.random_batches(batch_size, rng)),
+                output_signature=signature)
+            model.fit(batches.prefetch(tf.data.AUTOTUNE), epochs=10)
+            self.model = model
+            return
+
+        if streaming:
+            # Batches are generated on the fly every epoch, so memory stays flat as num_samples grows
+            epoch_seeds = np.random.SeedSequence(seed)
+            signature = (tf.TensorSpec((None, INPUT_SIZES[self.encoding]), tf.int8),
+                         tf.TensorSpec((None,), tf.float32))
+            batches = tf.data.Dataset.from_generator(
+                lambda: stream_batches(num_samples, batch_size, max_depth, self.encoding, workers,
+                                       epoch_seeds.spawn(1)[0]),
+                output_signature=signature)
+            model.fit(batches.prefetch(tf.data.AUTOTUNE), epochs=10)
+            self.model = model
+            return
+
+        # The samples live in shared memory so worker processes can fill them in place
+        X_train = SharedArray((num_samples, INPUT_SIZES[self.encoding]), np.int8)
+        y_train = SharedArray((num_samples,), np.float32)
+
+        try:
+            generate_samples(X_train, y_train, max_depth, self.encoding, workers, seed)
+            model.fit(X_train.array, y_train.array, epochs=10)
+        finally:
+            X_train.release()
+            y_train.release()
 
         self.model = model
 
-    def load_model(self, model_path):
-        self.model = load_model(model_path)
+    def load_model(self, model_path, backend="keras"):
+        # The "numpy" backend runs the forward pass with NumPy matmuls and doesn't need TensorFlow.
+        # The "remote" backend takes a "host:port" of a serving.py inference server as model_path.
+        with PROFILER.timer("model_load"):
+            if backend == "numpy":
+                model = NumpyModel(model_path)
+            elif backend == "remote":
+                from serving import RemoteModel
+                model = RemoteModel(model_path)
+            else:
+                from keras.models import load_model
+                model = load_model(model_path)
+        self.use_model(model)
+
+    def use_model(self, model):
+        # Any object with predict() and input_shape, e.g. a BatchingModel shared by several ChessAIs.
+        # Older models (like the shipped chess_model.h5) take the 64-slot legacy encoding
+        self.model = model
+        self.encoding = "planes" if model.input_shape[-1] == ENCODED_SIZE else "legacy"
 
     @staticmethod
-    def random_board(max_depth=100):
+    def random_board(max_depth=100, rng=random):
         random_board = chess.Board()
-        depth = random.randrange(0, max_depth)
+        depth = rng.randrange(0, max_depth)
 
         for _ in range(depth):
             all_moves = list(random_board.legal_moves)
-            random_move = random.choice(all_moves)
+            random_move = rng.choice(all_moves)
             random_board.push(random_move)
             if random_board.is_game_over():
                 break
@@ -62,32 +136,262 @@ class ChessAI:
 
         return board_representation
 
+    def encode_positions(self, boards, out=None):
+        if self.encoding == "planes":
+            return encode_boards(boards, out)
+
+        if out is None:
+            out = np.zeros((len(boards), INPUT_SIZES["legacy"]), dtype=np.int8)
+        for i, board in enumerate(boards):
+            out[i] = self.encode_position(board)
+        return out
+
+    @staticmethod
+    def move_scores(prediction, legal_moves):
+        # Probability the network assigns to each of the legal moves, in the same order
+        return prediction.flatten()[move_indices(legal_moves)]
+
     @staticmethod
     def decode_move(prediction, legal_moves):
-        move_probs = prediction.flatten()
-        legal_move_indices = [i for i, move in enumerate(legal_moves)]
-        move_index = np.argmax(move_probs[np.array(legal_move_indices)])  # Select the move with the highest probability
-        selected_move = legal_moves[legal_move_indices[move_index]]
+        return select_moves(prediction, [legal_moves])[0]  # Select the legal move with the highest probability
+
+    def enable_cache(self, maxsize=10000, path=None):
+        # Remember predictions by Zobrist hash, optionally persisted to a SQLite file at `path`
+        self.cache = PositionCache(maxsize, path)
+        return self.cache
+
+    def load_book(self, path):
+        # Opening book moves are played straight away, before the model is consulted
+        self.book = OpeningBook(path)
+        return self.book
 
-        return selected_move
+    def load_tablebases(self, directory):
+        # Endgame tables written by tablebase.py, exact for positions with few pieces
+        self.tablebases = EndgameTables(directory)
+        return self.tablebases
+
+    def known_move(self, board):
+        # Endgame table move first, then the opening book; None when neither covers the position
+        if self.tablebases is not None:
+            with PROFILER.timer("tablebase"):
+                move = self.tablebases.best_move(board)
+            if move is not None:
+                return move
+        if self.book is not None:
+            with PROFILER.timer("book"):
+                return self.book.choose(board)
+        return None
+
+    def predict_encoded(self, input_data, keys=None):
+        # Single forward pass over positions that are already encoded (e.g. by an EncodedBoard).
+        # With the cache enabled and Zobrist `keys` given (None for positions without one), only
+        # the positions the cache doesn't know go through the model.
+        if self.cache is None or keys is None:
+            return self.forward(input_data)
+        known = [i for i, key in enumerate(keys) if key is not None]
+        predictions = [None] * len(keys)
+        for i, prediction in zip(known, self.cache.get_many([keys[i] for i in known])):
+            predictions[i] = prediction
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if missing:
+            fresh = self.forward(input_data[missing])
+            self.cache.put_many([keys[i] for i in missing if keys[i] is not None],
+                                [row for i, row in zip(missing, fresh) if keys[i] is not None])
+            for i, prediction in zip(missing, fresh):
+                predictions[i] = prediction
+        return np.array(predictions)
+
+    def forward(self, input_data):
+        with PROFILER.timer("model_predict"):
+            prediction = self.model.predict(input_data, batch_size=len(input_data))
+        PROFILER.count("positions_predicted", len(input_data))
+        return prediction
+
+    def run_model(self, boards):
+        # Encode every board into one array and run a single forward pass
+        with PROFILER.timer("encode"):
+            input_data = self.encode_positions(boards)
+        return self.predict_encoded(input_data)
+
+    def predict_policies(self, boards):
+        if self.cache is None:
+            return self.run_model(boards)
+
+        keys = [chess.polyglot.zobrist_hash(board) for board in boards]
+        predictions = self.cache.get_many(keys)
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if missing:
+            fresh = self.run_model([boards[i] for i in missing])
+            self.cache.put_many([keys[i] for i in missing], fresh)
+            for i, prediction in zip(missing, fresh):
+                predictions[i] = prediction
+
+        return np.array(predictions)
+
+    def predict_moves(self, boards):
+        moves = [None] * len(boards)
+
+        # Game-over boards are skipped and come back as None
+        active = [i for i, board in enumerate(boards) if not board.is_game_over()]
+        if self.book is not None or self.tablebases is not None:
+            for i in active:
+                moves[i] = self.known_move(boards[i])
+            active = [i for i in active if moves[i] is None]
+        if not active:
+            return moves
+
+        predictions = self.predict_policies([boards[i] for i in active])
+        with PROFILER.timer("legal_moves"):
+            legal_moves = [list(boards[i].legal_moves) for i in active]
+        with PROFILER.timer("decode"):
+            selected = select_moves(predictions, legal_moves)
+        for i, move in zip(active, selected):
+            moves[i] = move
+
+        return moves
 
     def predict_move(self, board):
-        encoded_position = self.encode_position(board)
-        input_data = np.array([encoded_position])
-        prediction = self.model.predict(input_data)
-        legal_moves = list(board.legal_moves)
-        if board.is_game_over():
-            return None
-        return self.decode_move(prediction, legal_moves)
+        return self.predict_moves([board])[0]
+
+
+class SharedArray:
+    # NumPy array backed by a named shared-memory block that worker processes can attach to
+    def __init__(self, shape, dtype, name=None):
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.owner = name is None
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+
+    def spec(self):
+        return self.shm.name, self.array.shape, self.array.dtype.str
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def release(self):
+        del self.array
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def fill_samples(X, y, max_depth, encoding, rng, hashes=None):
+    chess_ai = ChessAI(encoding)
+    positions = [chess_ai.random_board(max_depth, rng) for _ in range(len(y))]
+    chess_ai.encode_positions(positions, X)
+    y[:] = [rng.random() for _ in range(len(y))]  # Placeholder evaluation
+    if hashes is not None:
+        hashes[:] = [chess.polyglot.zobrist_hash(position) for position in positions]
+
+
+def worker_pool(workers):
+    # Spawned, not forked: train() has already started TensorFlow by the time samples are
+    # generated, and TensorFlow doesn't survive a fork once its runtime is running
+    return multiprocessing.get_context("spawn").Pool(workers)
+
+
+def generate_chunk(x_spec, y_spec, start, end, max_depth, encoding, seed):
+    X = SharedArray.attach(x_spec)
+    y = SharedArray.attach(y_spec)
+
+    try:
+        fill_samples(X.array[start:end], y.array[start:end], max_depth, encoding, random.Random(seed))
+    finally:
+        X.release()
+        y.release()
+
+    return end - start
+
+
+def generate_samples(X, y, max_depth, encoding="planes", workers=1, seed=None, chunk_size=4096):
+    # Every chunk gets its own seed so results don't depend on which worker runs it
+    num_samples = len(y.array)
+    starts = range(0, num_samples, chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    tasks = [(X.spec(), y.spec(), start, min(start + chunk_size, num_samples), max_depth, encoding,
+              int(chunk_seed.generate_state(1)[0])) for start, chunk_seed in zip(starts, seeds)]
+
+    if workers <= 1:
+        for task in tasks:
+            generate_chunk(*task)
+        return num_samples
+
+    with worker_pool(workers) as pool:
+        return sum(pool.starmap(generate_chunk, tasks))
+
+
+def generate_batch(batch_size, max_depth, encoding, seed, with_hashes=False):
+    X = np.zeros((batch_size, INPUT_SIZES[encoding]), dtype=np.int8)
+    y = np.zeros(batch_size, dtype=np.float32)
+    if not with_hashes:
+        fill_samples(X, y, max_depth, encoding, random.Random(seed))
+        return X, y
+
+    hashes = np.zeros(batch_size, dtype=np.uint64)
+    fill_samples(X, y, max_depth, encoding, random.Random(seed), hashes)
+    return X, y, hashes
+
+
+def stream_batches(num_samples, batch_size, max_depth, encoding="planes", workers=1, seed=None, prefetch=8,
+                   start=0, with_hashes=False):
+    # Yield (X, y) batches; with several workers at most `prefetch` batches are in flight at once.
+    # Samples before `start` are skipped but their batches still consume their seeds. A batch
+    # that `start` falls inside is generated whole and its first rows are dropped.
+    seeds = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+    def batch_tasks():
+        for offset in range(0, num_samples, batch_size):
+            batch_seed = int(seeds.spawn(1)[0].generate_state(1)[0])
+            size = min(batch_size, num_samples - offset)
+            if offset + size > start:
+                yield max(0, start - offset), (size, max_depth, encoding, batch_seed, with_hashes)
+
+    def trim(skip, batch):
+        return tuple(field[skip:] for field in batch) if skip else batch
+
+    tasks = batch_tasks()
+
+    if workers <= 1:
+        for skip, task in tasks:
+            yield trim(skip, generate_batch(*task))
+        return
+
+    with worker_pool(workers) as pool:
+        pending = deque()
+        for skip, task in tasks:
+            pending.append((skip, pool.apply_async(generate_batch, task)))
+            if len(pending) >= prefetch:
+                skip, result = pending.popleft()
+                yield trim(skip, result.get())
+        while pending:
+            skip, result = pending.popleft()
+            yield trim(skip, result.get())
+
+
+def build_dataset(path, num_samples, max_depth, encoding="planes", workers=1, seed=None, batch_size=1024,
+                  shard_size=64 * 1024):
+    # Write generated samples to a sharded on-disk dataset, resuming after the samples already stored
+    if shard_size % batch_size:
+        raise ValueError("shard_size must be a multiple of batch_size")
+
+    with ShardWriter(path, shard_size) as writer:
+        for X, y, hashes in stream_batches(num_samples, batch_size, max_depth, encoding, workers, seed,
+                                           start=len(writer), with_hashes=True):
+            writer.append(x=X, y=y, hash=hashes)
+
+    return path
 
 
 if __name__ == '__main__':
     NS = 1000000
     MAXDEPTH = 3
+    WORKERS = os.cpu_count()
 
     chess_ai = ChessAI()
     start = datetime.now()
-    chess_ai.train(num_samples=NS, max_depth=MAXDEPTH)
+    chess_ai.train(num_samples=NS, max_depth=MAXDEPTH, workers=WORKERS)
 
     # Save the model
     chess_ai.model.save("chess_model.h5")